@@ -0,0 +1,116 @@
+"""
+Persistent cache of the model responses, stored in a SQLite file.
+
+Queries are sent with temperature 0 and the prompts are deterministic, so a rerun (e.g., after a crash)
+can reuse the answers that were already paid for.
+Entries are keyed by the hash of (model key in utils.f_query, full prompt, generation params).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ["off", "read", "write", "readwrite"]
+
+
+class ResponseCache:
+    def __init__(self, path: str = ".cache/responses.sqlite", mode: str = "readwrite", max_entries: int = 1_000_000):
+        """
+        path:str, the SQLite file where the responses are stored
+        mode:str, one of CACHE_MODES: 'read' only looks up answers, 'write' only stores them
+        max_entries:int, when exceeded, the least recently used entries are evicted
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Cache mode {mode} not supported")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._num_entries = 0
+
+        if mode == "off":
+            return
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The connection is shared by the query threads, access is serialized by self._lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT,
+            last_used REAL
+        )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        self._num_entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def can_read(self) -> bool:
+        return self.mode in ["read", "readwrite"]
+
+    @property
+    def can_write(self) -> bool:
+        return self.mode in ["write", "readwrite"]
+
+    @staticmethod
+    def make_key(model: str, prompt: str, params: dict = None) -> str:
+        payload = json.dumps([model, prompt, params or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, prompt: str, params: dict = None) -> str | None:
+        if not self.can_read:
+            return None
+
+        key = self.make_key(model, prompt, params)
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return row[0]
+
+    def put(self, model: str, prompt: str, response: str, params: dict = None) -> None:
+        if not self.can_write:
+            return
+
+        key = self.make_key(model, prompt, params)
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO responses VALUES (?, ?, ?, ?)",
+                                        (key, model, response, time.time()))
+            self._num_entries += cursor.rowcount
+            if self._num_entries > self.max_entries:
+                self._evict(self._num_entries - self.max_entries)
+            self._conn.commit()
+
+    def _evict(self, n: int) -> None:
+        cursor = self._conn.execute("""DELETE FROM responses WHERE key IN (
+            SELECT key FROM responses ORDER BY last_used LIMIT ?
+        )""", (n,))
+        self._num_entries -= cursor.rowcount
+        self.evictions += cursor.rowcount
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": self._num_entries
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
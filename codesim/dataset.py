@@ -0,0 +1,213 @@
+"""
+Lazy loading of the datasets in ./data.
+
+The datasets are JSON arrays of samples (see my_types.Sample), and in the kim-schuster ones each
+sample repeats the whole prefix of the previous ones, so the files are parsed incrementally
+and the samples are yielded one at a time instead of loading the whole file first.
+Files ending with .jsonl, one sample per line, are supported as well, and any of the formats can
+be gzip-compressed (e.g. .jsonl.gz, about 10 times smaller than the indent=4 JSON files).
+The results of a dataset are saved under the same name whatever its format (see get_dataset_name).
+
+The kim-schuster datasets can also be stored in a compact format (see to_compact), a JSON object
+where the text of each operation sequence is stored once, as the text added at each step, and
+each sample is [sequence, step, box, label_syn, label_nat]. Files are told apart by their first
+character, '[' or '{', and the syn/nat text of each sample is rebuilt only when it is read.
+Convert datasets with `python3 -m codesim.dataset --format {compact,jsonl.gz} --output-dir <dir> <files or dirs>`.
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+from typing import Iterable, Iterator
+
+from .my_types import Sample
+
+g_decoder = json.JSONDecoder()
+g_extensions = [".jsonl.gz", ".json.gz", ".jsonl", ".json"]
+
+
+def open_dataset(path: str, mode: str = 'r'):
+    """Opens a dataset file as text, decompressing it if its name ends with .gz."""
+    if path.endswith(".gz"):
+        # mtime=0, so the same samples are always compressed to the same bytes
+        return io.TextIOWrapper(gzip.GzipFile(path, mode + 'b', compresslevel=6, mtime=0), encoding="utf-8")
+    return open(path, mode)
+
+
+def get_dataset_name(path: str) -> str:
+    """The name of a dataset in the results and logs, the file name with the .json extension whatever the format."""
+    name = os.path.basename(path)
+    for extension in g_extensions:
+        if name.endswith(extension):
+            return name[:-len(extension)] + ".json"
+    return name
+
+
+def iter_records(path: str, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """Yields the JSON objects of a dataset file, without reading the whole file in memory."""
+    with open_dataset(path, 'r') as f:
+        if path.endswith((".jsonl", ".jsonl.gz")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        buffer = f.read(chunk_size).lstrip()
+        if buffer.startswith("{"):
+            # the compact format is a fraction of the size of the samples it encodes
+            compact = json.loads(buffer + f.read())
+            yield from iter_compact(compact)
+            return
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} is not a JSON array of samples")
+        pos = 1
+        eof = False
+        while True:
+            # skip the separators between the objects
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                record, end = g_decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the object continues in the next chunk (unless the file is over)
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = chunk == ""
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield record
+            pos = end
+
+
+def iter_samples(path: str) -> Iterator[Sample]:
+    """Yields the samples of a dataset file one at a time."""
+    for record in iter_records(path):
+        yield Sample(**record)
+
+
+def write_records(path: str, records: Iterable[dict]) -> int:
+    """
+    Writes the records one at a time and returns the number of records: one per line if path ends
+    with .jsonl(.gz), otherwise as the same JSON array that json.dump(list(records), f, indent=4) writes.
+    """
+    num_records = 0
+    with open_dataset(path, 'w') as f:
+        if path.endswith((".jsonl", ".jsonl.gz")):
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                num_records += 1
+            return num_records
+
+        f.write("[")
+        for record in records:
+            # the record indented as an item of the array
+            f.write(("," if num_records > 0 else "") + json.dumps([record], indent=4)[1:-2])
+            num_records += 1
+        f.write("\n]" if num_records > 0 else "]")
+    return num_records
+
+
+def to_compact(records: list[dict]) -> dict:
+    """
+    Encodes the records of a kim-schuster dataset in the compact format.
+    Consecutive samples whose syn and nat text extend the ones of the previous sample are
+    steps of the same operation sequence, only the text that is added is stored.
+    """
+    sequences = []
+    samples = []
+    prev_syn, prev_nat = None, None
+    for record in records:
+        syn, nat = record["syn"], record["nat"]
+        if (syn, nat) != (prev_syn, prev_nat):
+            if prev_syn is not None and syn.startswith(prev_syn) and nat.startswith(prev_nat):
+                sequences[-1]["syn"].append(syn[len(prev_syn):])
+                sequences[-1]["nat"].append(nat[len(prev_nat):])
+            else:
+                sequences.append({"syn": [syn], "nat": [nat]})
+            prev_syn, prev_nat = syn, nat
+
+        # the labels are {box: contents}, with the same box in label_syn and label_nat
+        (box, label_syn), = record["label_syn"].items()
+        (label_nat,) = record["label_nat"].values()
+        samples.append([len(sequences) - 1, len(sequences[-1]["syn"]) - 1, int(box), label_syn, label_nat])
+
+    return {"sequences": sequences, "samples": samples}
+
+
+def iter_compact(compact: dict) -> Iterator[dict]:
+    """Yields the records encoded by to_compact, building the text of each sample when needed."""
+    current = None
+    for seq, step, box, label_syn, label_nat in compact["samples"]:
+        # the samples of the same step are stored one after the other, the text is built once for them
+        if current != (seq, step):
+            current = (seq, step)
+            sequence = compact["sequences"][seq]
+            syn, nat = "".join(sequence["syn"][:step + 1]), "".join(sequence["nat"][:step + 1])
+        yield {
+            "syn": syn,
+            "nat": nat,
+            "label_syn": {str(box): label_syn},
+            "label_nat": {str(box): label_nat}
+        }
+
+
+def write_compact(path: str, records: list[dict]) -> None:
+    with open(path, "w") as f:
+        json.dump(to_compact(records), f, separators=(",", ":"))
+
+
+def get_output_path(path: str, root: str, output_dir: str, format: str) -> str:
+    """The path of the converted dataset in output_dir, in the same subdirectory of root as path."""
+    out_path = os.path.join(output_dir, os.path.relpath(path, root))
+    if format == "jsonl.gz":
+        out_path = os.path.join(os.path.dirname(out_path), get_dataset_name(out_path)[:-len(".json")] + ".jsonl.gz")
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts datasets to the compact kim-schuster format or to compressed JSONL.")
+    parser.add_argument('paths', nargs='+', type=str, help='Datasets to convert, or directories with the datasets to convert (e.g. ./data)')
+    parser.add_argument('--output-dir', required=True, type=str, help='Directory where the converted datasets are saved, with the same names and subdirectories')
+    parser.add_argument('--format', default='compact', choices=['compact', 'jsonl.gz'], help='compact is for the kim-schuster datasets only, jsonl.gz for all of them')
+    args = parser.parse_args()
+
+    # the prompts rendered next to the datasets are not datasets themselves
+    from .queries import is_prompts_file
+
+    conversions = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    if filename.endswith(tuple(g_extensions)) and not filename.startswith(".") and not is_prompts_file(filename):
+                        file_path = os.path.join(dirpath, filename)
+                        conversions.append((file_path, get_output_path(file_path, path, args.output_dir, args.format)))
+        else:
+            conversions.append((path, get_output_path(path, os.path.dirname(path), args.output_dir, args.format)))
+
+    total_in, total_out = 0, 0
+    for path, out_path in conversions:
+        if os.path.abspath(out_path) == os.path.abspath(path):
+            raise ValueError(f"{path} would be overwritten, choose another output directory")
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        records = list(iter_records(path))
+        if args.format == "compact":
+            write_compact(out_path, records)
+        else:
+            write_records(out_path, records)
+        # the conversion must not change the samples
+        assert list(iter_records(out_path)) == records, path
+        total_in += os.path.getsize(path)
+        total_out += os.path.getsize(out_path)
+        print(f"{path}: {os.path.getsize(path)} -> {os.path.getsize(out_path)} bytes")
+    print(f"Converted {len(conversions)} datasets: {total_in} -> {total_out} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Interpreter of the straight-line programs generated in problem.py (StraightLine, ParallelPaths, CriticalPath).
+
+The programs are assignments separated by newlines or '; ', in the forms `x=3`, `x = 0`, `x += y`,
+`x -= 2` and `x *= 2`, where the right-hand side is either an integer or a variable.
+They are evaluated without exec(), so the labels of the existing datasets can be checked quickly:
+`python3 -m codesim.evaluator [files]`, by default all the datasets of these problems in ./data.
+"""
+
+import argparse
+import glob
+import re
+import sys
+import time
+
+from .dataset import iter_records
+
+g_statement = re.compile(r"\s*([A-Za-z_]\w*)\s*(=|\+=|-=|\*=)\s*(-?\d+|[A-Za-z_]\w*)\s*")
+g_problems = ["CriticalPath", "StraightLine", "ParallelPaths"]
+
+
+def apply(state: dict[str, int], dst: str, op: str, src: str | int) -> None:
+    """Runs `dst op src` on the variables in state, src is either an int or the name of a variable."""
+    value = src if isinstance(src, int) else state[src]
+    match op:
+        case "=":
+            state[dst] = value
+        case "+=":
+            state[dst] += value
+        case "-=":
+            state[dst] -= value
+        case "*=":
+            state[dst] *= value
+        case _:
+            raise ValueError(f"Operation {op} not supported")
+
+
+def parse(program: str) -> list[tuple[str, str, str | int]]:
+    """Returns the (dst, op, src) statements of a program."""
+    statements = []
+    for line in program.splitlines():
+        for statement in line.split(";"):
+            if not statement.strip():
+                continue
+            match = g_statement.fullmatch(statement)
+            if match is None:
+                raise ValueError(f"Cannot parse statement '{statement}'")
+            dst, op, src = match.groups()
+            statements.append((dst, op, (src if src[0].isalpha() or src[0] == "_" else int(src))))
+    return statements
+
+
+def evaluate(program: str, state: dict[str, int] = None) -> dict[str, int]:
+    """Returns the value of each variable at the end of the program, starting from state if given."""
+    state = ({} if state is None else state)
+    for dst, op, src in parse(program):
+        apply(state, dst, op, src)
+    return state
+
+
+def check_sample(record: dict) -> bool:
+    """True if the syn labels of a sample match the values its program computes."""
+    state = evaluate(record["syn"])
+    return all(state.get(var) == value for var, value in record["label_syn"].items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the labels of the straight-line datasets by running their programs.")
+    parser.add_argument('paths', nargs='*', type=str, help=f'Datasets to check, by default the ones in ./data/{{{",".join(g_problems)}}}')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(p for problem in g_problems for p in glob.glob(f"./data/{problem}/*.json"))
+    num_samples, num_errors = 0, 0
+    start = time.perf_counter()
+    for path in paths:
+        for i, record in enumerate(iter_records(path)):
+            num_samples += 1
+            if not check_sample(record):
+                num_errors += 1
+                print(f"{path}: sample {i} has labels {record['label_syn']}, the program computes {evaluate(record['syn'])}")
+
+    print(f"Checked {num_samples} samples in {len(paths)} files in {time.perf_counter() - start:.2f}s, {num_errors} wrong labels")
+    if num_errors > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,26 +15,50 @@ import datetime
 import json
 import argparse
 import random
+import re
 import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Iterable
 from pydantic import BaseModel
-import pandas as pd
 import os
-import wandb
-from pydantic.json import pydantic_encoder
 import backoff
 from . import utils
+from .cache import ResponseCache, CACHE_MODES
+from .results import ResultsStore
+from .logs import LogWriter, LOG_FORMATS, to_txt, get_txt_path
+from .tracking import WandbTracker
+from .dataset import iter_samples, get_dataset_name
+from .queries import get_prompts_path, is_prompts_file, get_file_hash, get_template_hash, get_source_hash, is_up_to_date, write_queries, iter_queries
 
 from .my_types import Sample, OperationType
 from . import prompt
 
 # Used to map obj-1 and similars to a string.
 g_object_map = dict()
-
-# Tables used to store the logs of the system.
-g_has_wandb = False
-g_nat_logs = None
-g_syn_logs = None
-# init wandb tables
+# For each prefix, the function that replaces the objects of g_object_map, compiled when first needed.
+g_object_substitutions = dict()
+
+# Background logging to wandb, None until the first run tracked with wandb.
+g_tracker = None
+
+# Templates of prompt.py used by each operation, hashed in the materialized prompts.
+g_templates = {
+    OperationType.kim_schuster: prompt.Boxes,
+    OperationType.critical_path: prompt.CriticalPath,
+    OperationType.parallel_paths: prompt.ParallelPaths,
+    OperationType.straight_line: prompt.StraightLine,
+    OperationType.nested_loop: prompt.Loops,
+    OperationType.sorting: prompt.Sort
+}
+
+# Cache of the model responses, None when disabled.
+g_cache = None
+# Keys of the model config that do not change the responses (secrets, endpoints, rate limits), left out of the cache keys.
+g_non_generation_params = {"key", "api_base", "api_type", "api_version", "rpm", "tpm", "expected_completion_tokens", "latency"}
+# Store of the results, opened when the first results are saved if init_results was not called.
+g_results = None
 
 class PromptAndCheck(BaseModel):
     prompt: str
@@ -48,10 +72,6 @@ class LogInfo(BaseModel):
     is_correct: bool
 
 def main():
-    global g_nat_logs
-    global g_syn_logs
-    global g_has_wandb
-
     parser = argparse.ArgumentParser(description="Start experiments for the CodeSimulation project.")
     parser.add_argument('-o', '--operation', choices=['kim-schuster', 'critical-path', 'parallel-paths', 'straight-line', 'nested-loop', 'sorting'], 
                         help='Type of operation to perform')
@@ -59,17 +79,23 @@ def main():
     parser.add_argument("--dataset_path", type=str, help="Path to the dataset", default=None)
     parser.add_argument('-m', '--model', type=str, help='Model to use for the experiment')
     parser.add_argument('--wandb', action='store_true', help='Use wandb for logging, if not, use default txt file')
+    parser.add_argument('--concurrency', default=1, type=int, help='Number of samples queried in parallel')
+    parser.add_argument('--batch-size', default=1, type=int, help='Number of prompts generated in a single batch, for local models')
+    parser.add_argument('--cache-mode', default='off', choices=CACHE_MODES, help='Whether to read and/or write model responses from the cache')
+    parser.add_argument('--cache-path', default='.cache/responses.sqlite', type=str, help='Path of the SQLite file with the cached responses')
+    parser.add_argument('--cache-max-entries', default=1_000_000, type=int, help='Maximum number of cached responses, the least recently used are evicted')
+    parser.add_argument('--results-path', default='results/results.sqlite', type=str, help='Path of the SQLite file where the results are stored')
+    parser.add_argument('--log-format', default='jsonl', choices=LOG_FORMATS, help='Format of the logs in logs/<operation>, txt is the format of the previous versions, converted from jsonl at the end of each dataset')
+    parser.add_argument('--prompt-seed', default=0, type=int, help='Seed of the prompts rendered in <dataset>.prompts.jsonl.gz, the first time a dataset is run or when the templates change')
+    parser.add_argument('--render-prompts', action='store_true', help='Render the prompts at each run, as in the previous versions, instead of reading them from <dataset>.prompts.jsonl.gz')
+    parser.add_argument('--materialize-only', action='store_true', help='Only render the prompts of the datasets in <dataset>.prompts.jsonl.gz, without running the experiments')
 
     args = parser.parse_args()
-    g_has_wandb = args.wandb
+    init_cache(args.cache_mode, args.cache_path, args.cache_max_entries)
+    init_results(args.results_path)
 
     op_type: OperationType = OperationType(args.operation)
-    dataset_base = get_dataset_path(op_type)
-    dataset_list = []
-    for dataset in os.listdir(dataset_base):
-        if ".json" in dataset:
-            dataset_list.append(os.path.join(dataset_base, dataset))
-    dataset_list = sorted(dataset_list)
+    dataset_list = list_datasets(get_dataset_path(op_type))
 
     if len(dataset_list) < args.dataset_idx:
         raise ValueError("Could node load dataset of the given index")
@@ -79,115 +105,146 @@ def main():
     if args.dataset_path is not None:
         print("Overwriting dataset list with the given path")
         dataset_list = [args.dataset_path]
-        dataset_base = os.path.dirname(args.dataset_path)
 
     print(f"Operation: {args.operation}")
     print(f"Dataset Path: {args.dataset_idx}")
 
+    if args.materialize_only:
+        for dataset_path in dataset_list:
+            print(f"Prompts saved in {materialize_queries(dataset_path, op_type, args.prompt_seed)}")
+        return
+
+    for dataset_path in dataset_list:
+        run_dataset(op_type, args.model, dataset_path,
+                    use_wandb=args.wandb,
+                    concurrency=args.concurrency,
+                    batch_size=args.batch_size,
+                    dataset_idx=args.dataset_idx,
+                    log_format=args.log_format,
+                    prompt_seed=None if args.render_prompts else args.prompt_seed)
+    print(f"Saved {g_results.export_csv(op_type.value, args.model)}")
+    close_tracker()
+
+def init_cache(mode: str, path: str, max_entries: int = 1_000_000):
+    global g_cache
+    if g_cache is not None:
+        g_cache.close()
+    g_cache = ResponseCache(path, mode=mode, max_entries=max_entries) if mode != "off" else None
+
+def list_datasets(dataset_base: str) -> list[str]:
+    datasets = dict()
+    for dataset in sorted(os.listdir(dataset_base)):
+        # hidden files are the ones still being written by codesim.generate
+        if ".json" in dataset and not dataset.startswith(".") and not is_prompts_file(dataset):
+            # x.json and its converted copy x.jsonl.gz share their results, only the first one is run
+            name = get_dataset_name(dataset)
+            if name in datasets:
+                print(f"Skipping {dataset}, same dataset as {datasets[name]}")
+                continue
+            datasets[name] = dataset
+    return sorted(os.path.join(dataset_base, dataset) for dataset in datasets.values())
+
+def run_dataset(op_type: OperationType, model: str, dataset_path: str, use_wandb: bool = False, concurrency: int = 1, batch_size: int = 1, dataset_idx: int = -1, log_format: str = "jsonl", prompt_seed: int | None = 0):
+    """
+    Runs the experiment on a single dataset file, then saves the results.
+    The logs are written as the samples are answered (see logs.LogWriter).
+    The objects are sampled again for each dataset, so the prompts do not depend on the
+    datasets that were run before in the same process.
+    The prompts are read from the file written by materialize_queries with prompt_seed, or
+    rendered while the samples are read if prompt_seed is None.
+    """
+    operation = op_type.value
+    tracker = get_tracker() if use_wandb else None
+
+    # each query thread can keep its own connection to the endpoint
+    utils.set_pool_size(concurrency)
+
     load_and_sample_objects()
     print(f"Objects Sampled: {g_object_map}")
 
-    for dataset_path in dataset_list:
-        g_syn_logs = []
-        g_nat_logs = []
-        if g_has_wandb:
-            wandb.init(project="codesim",
-                config= {
-                    "operation": args.operation,
-                    "dataset_idx": args.dataset_idx,
-                    "dataset_path": os.path.basename(dataset_path),
-                    "model": args.model
-                }
-            )
-            
-        print("Running experiment for", dataset_path)
-        # Load the dataset as json
-        samples = []
-        with open(dataset_path, 'r') as f:
-            allfile = f.read()
-            jsondata = json.loads(allfile)
-
-            for sample in jsondata:
-                # print(sample)
-                samples.append(Sample(**sample))
-                # break
-
-        # print(samples[0])
-        # send_request(samples[0])
-
-        # print(format_query(samples[0], op_type))
-        accuracy_nat, accuracy_syn = experiment(samples, args.model, op_type)
-        save_results(accuracy_nat, accuracy_syn, args, os.path.basename(dataset_path))
-        
-        if g_has_wandb:
-            wandb.log({"accuracy_nat": accuracy_nat, "accuracy_syn": accuracy_syn})
-        # Log everything at the end
-
-        if g_has_wandb:
-            nat_table = wandb.Table(columns=["prompt", "label", "response", "full_response", "is_correct"])
-            for log in g_nat_logs:
-                nat_table.add_data(*log.model_dump().values())
-                
-            artifact = wandb.Artifact(f"nat-{args.operation}-{args.model}", type="dataset")
-            artifact.add(nat_table, "results-nat")
-
-            syn_table = wandb.Table(columns=["prompt", "label", "response", "full_response", "is_correct"])
-            for log in g_syn_logs:
-                syn_table.add_data(*log.model_dump().values())
-            artifact_syn = wandb.Artifact(f"syn-{args.operation}-{args.model}", type="dataset")
-            artifact_syn.add(syn_table, "results-syn")
-            wandb.log_artifact(artifact)
-            wandb.log_artifact(artifact_syn)
-
-        # write to the logs
-        basedir = os.path.join("logs", args.operation)
-        os.makedirs(basedir, exist_ok=True)
-        # date in yy-mm-dd-hh-mm
-        date = datetime.datetime.now().strftime("%mM-%dD-%Hh-%Mm%Ss")
-        with open(f"{basedir}/{os.path.basename(dataset_path)}-{args.model}-{date}.txt", 'w') as f:
-            f.write("Natural Logs\n")
-            json.dump(g_nat_logs, f, default=pydantic_encoder)
-            f.write("\n")
-            f.write(f"Accuracy: {accuracy_nat}")
-            f.write("\n")
-            f.write("Synthetic Logs\n")
-            json.dump(g_syn_logs, f, default=pydantic_encoder)
-            f.write("\n")
-            f.write(f"Accuracy: {accuracy_syn}")
-            f.write("\n")
-
-        # close wandb
-        if g_has_wandb:
-            wandb.finish()
-
-def save_results(accuracy_nat, accuracy_syn, args, dataset_name):
-    basedir = os.path.join("results", args.operation)
-    os.makedirs(basedir, exist_ok=True)
+    if tracker is not None:
+        tracker.start_run({
+            "operation": operation,
+            "dataset_idx": dataset_idx,
+            "dataset_path": get_dataset_name(dataset_path),
+            "model": model,
+            "prompt_seed": prompt_seed
+        })
+
+    print("Running experiment for", dataset_path)
+    if prompt_seed is None:
+        # The samples are read lazily, so the first queries are sent while the file is still being parsed
+        samples, queries = iter_samples(dataset_path), None
+    else:
+        prompts_path = materialize_queries(dataset_path, op_type, prompt_seed)
+        print(f"Prompts read from {prompts_path}")
+        samples, queries = None, load_queries(prompts_path)
+
+    # print(samples[0])
+    # send_request(samples[0])
+
+    # print(format_query(samples[0], op_type))
+    journal_path = get_journal_path(operation, dataset_path, model)
+    log_writer = LogWriter(operation, get_dataset_name(dataset_path), model, compress=log_format == "jsonl.gz")
+    try:
+        accuracy_nat, accuracy_syn = experiment(samples, model, op_type, concurrency=concurrency, journal_path=journal_path, batch_size=batch_size, log_writer=log_writer, tracker=tracker, queries=queries)
+        log_writer.write_accuracy(accuracy_nat, accuracy_syn)
+    finally:
+        log_writer.close()
+    save_results(accuracy_nat, accuracy_syn, operation, model, get_dataset_name(dataset_path))
+    if g_cache is not None:
+        print(f"Cache: {g_cache.stats()}")
+    for client_stats in utils.get_client_stats():
+        print(f"Client: {client_stats}")
     
-    filename = f"{basedir}/{args.model}.csv"
+    if tracker is not None:
+        # logged by the worker while the next dataset runs
+        tracker.log_metrics({"accuracy_nat": accuracy_nat, "accuracy_syn": accuracy_syn})
+        tracker.finish_run(operation, model)
+
+    log_path = log_writer.path
+    if log_format == "txt":
+        log_path = get_txt_path(log_writer.path)
+        to_txt(log_writer.path, log_path)
+        os.remove(log_writer.path)
+    print(f"Logs saved in {log_path}")
+
+    # the dataset is complete, a new run starts from scratch
+    os.remove(journal_path)
+
+    return accuracy_nat, accuracy_syn
+
+def get_tracker() -> WandbTracker:
+    global g_tracker
+    if g_tracker is None:
+        g_tracker = WandbTracker(project="codesim")
+    return g_tracker
+
+def close_tracker():
+    """Waits for the tracked runs to be logged."""
+    global g_tracker
+    if g_tracker is not None:
+        print("Waiting for the wandb logs...")
+        g_tracker.close()
+        g_tracker = None
+
+def save_results(accuracy_nat, accuracy_syn, operation, model, dataset_name):
     curr_date = datetime.datetime.now().strftime("%mM-%dD-%Hh-%Mm%Ss")
-    # check if the file exists
-    if os.path.exists(filename):
-        df = pd.read_csv(filename)
-        new_result = {
-            "accuracy_nat": accuracy_nat, 
-            "accuracy_syn": accuracy_syn, 
-            "date": curr_date,
-            "dataset": dataset_name
-        }
-        df = pd.concat([df, pd.DataFrame([new_result])], ignore_index=True)
-        # order by dataset name and then date
-        df = df.sort_values(by=["dataset", "date"])
-        df.to_csv(filename, index=False)
-    else:    
-        df = pd.DataFrame([{
-            "accuracy_nat": accuracy_nat, 
-            "accuracy_syn": accuracy_syn, 
-            "date": curr_date,
-            "dataset": dataset_name
-        }])
-        df.to_csv(filename, index=False)
-        
+    store = get_results_store()
+    store.add(operation, model, dataset_name, accuracy_nat, accuracy_syn, curr_date)
+    # the CSV read by plot.ipynb is up to date even if the run is killed before the next dataset
+    print(f"Results saved in {store.export_csv(operation, model)}")
+
+def init_results(path: str):
+    global g_results
+    if g_results is not None:
+        g_results.close()
+    g_results = ResultsStore(path)
+
+def get_results_store() -> ResultsStore:
+    if g_results is None:
+        init_results("results/results.sqlite")
+    return g_results
 
 def get_dataset_path(operation: OperationType):
     base = "./data"
@@ -207,10 +264,8 @@ def get_dataset_path(operation: OperationType):
         case _:
             raise ValueError("Operation Type not supported")
 
-def load_and_sample_objects():
-    global g_object_map
-    file = "./data/objects_with_bnc_frequency.csv"
-
+@lru_cache
+def load_object_frequencies(file: str = "./data/objects_with_bnc_frequency.csv") -> dict[str, int]:
     sample_freq = dict()
     # read and load csv file, has two columns, name and frequency, we need to use sample categorically using the frequency
     with open(file, 'r') as f:
@@ -218,11 +273,17 @@ def load_and_sample_objects():
         next(reader, None)  # skip the headers
         for row in reader:
             sample_freq[row[0]] = int(row[1])
+    return sample_freq
+
+def load_and_sample_objects():
+    global g_object_map
+    sample_freq = load_object_frequencies()
 
     random.seed(12) # so that is always the same
     # k is choosen arbitrarily, but we need the maximum number of objects anyways.
     sampled_objects = random.choices(list(sample_freq.keys()), k=10, weights=list(sample_freq.values()))
     g_object_map = {i: obj for i, obj in enumerate(sampled_objects)}
+    g_object_substitutions.clear()
 
 def compare_answers(answer: str, label: str, op_type):
     match op_type:
@@ -242,24 +303,105 @@ def compare_answers(answer: str, label: str, op_type):
         case _:
             return answer == label
 
-def experiment(samples: list[Sample], model: str, op_type: OperationType):
-    global g_nat_logs
-    global g_syn_logs
+def get_prompts_header(dataset_path: str, op_type: OperationType, seed: int) -> dict:
+    """How the prompts of a dataset are rendered, with the objects of load_and_sample_objects."""
+    return {
+        "operation": op_type.value,
+        "dataset": get_dataset_name(dataset_path),
+        "dataset_hash": get_file_hash(dataset_path),
+        "template_hash": get_template_hash(g_templates[op_type], g_object_map),
+        "code_hash": get_source_hash([format_query, substitute_objects, compile_object_substitution]),
+        "seed": seed
+    }
+
+def materialize_queries(dataset_path: str, op_type: OperationType, seed: int = 0) -> str:
+    """
+    Renders the syn and nat prompts of all the samples of a dataset with random.Random(seed), and saves
+    them in <dataset>.prompts.jsonl.gz (see queries.py), unless the file is up to date. Returns its path.
+    """
+    load_and_sample_objects()
+    path = get_prompts_path(dataset_path)
+    header = get_prompts_header(dataset_path, op_type, seed)
+    if is_up_to_date(path, header):
+        return path
+
+    rng = random.Random(seed)
+    # rendered while the samples are read, the prompts of the dataset are never all in memory
+    rendered = (tuple(query.model_dump() for query in format_query(sample, op_type, rng=rng))
+                for sample in iter_samples(dataset_path))
+    write_queries(path, header, rendered)
+    return path
+
+def load_queries(path: str) -> Iterable[tuple[PromptAndCheck, PromptAndCheck]]:
+    """Yields the (syn, nat) prompts saved by materialize_queries, one sample at a time."""
+    for query_syn, query_nat in iter_queries(path):
+        yield PromptAndCheck(**query_syn), PromptAndCheck(**query_nat)
+
+def get_journal_path(operation: str, dataset_path: str, model: str) -> str:
+    return os.path.join("logs", operation, f"{get_dataset_name(dataset_path)}-{model}.journal.jsonl")
+
+def load_journal(journal_path: str) -> dict[int, dict]:
+    """
+    Returns the records of the samples already answered, indexed by the position of the sample.
+    A truncated last line (e.g., after a crash) is ignored.
+    """
+    records = dict()
+    if journal_path is None or not os.path.exists(journal_path):
+        return records
+
+    with open(journal_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["idx"]] = record
+    return records
+
+def experiment(samples: Iterable[Sample], model: str, op_type: OperationType, concurrency: int = 1, journal_path: str = None, batch_size: int = 1, log_writer: LogWriter = None, tracker: WandbTracker = None, queries: Iterable[tuple[PromptAndCheck, PromptAndCheck]] = None):
+    """
+    Queries the model with the syn and nat version of each sample.
+    samples can be lazy (see dataset.iter_samples): they are read as the queries are sent,
+    except with batch_size > 1, where all the prompts are needed to sort them.
+    With concurrency > 1, up to `concurrency` samples are in flight at the same time, while
+    results and logs are still collected in the order of `samples`.
+    With batch_size > 1, the syn and nat prompts of all the samples are sorted by length and
+    sent in batches of batch_size prompts (see utils.queryLLM_batch), e.g., for local models.
+    If journal_path is given, each answered sample is appended to it, and samples already
+    in the journal (from a previous, interrupted run) are not queried again.
+    If log_writer is given, the samples are logged in order as they are collected, and sent to
+    tracker if given.
+    If queries is given, the (syn, nat) prompts of each sample (see load_queries), samples is
+    not read and the prompts are not formatted again.
+    """
+
+    if queries is None:
+        queries = (format_query(sample, op_type) for sample in samples)
 
     correct_nat = 0
     correct_syn = 0
-    for sample in samples:
-        query_syn, query_nat = format_query(sample, op_type)
-        # print(query_syn.prompt)
-        # print(query_nat.prompt)
-        # print("Synthetic Answer:", query_syn.answer, query_nat.answer)
-        syn_result, syn_whole_answer = get_answer(query_syn.prompt, model)
-        if compare_answers(syn_result, query_syn.answer, op_type):
-            correct_syn += 1
-
-        nat_result, nat_whole_answer = get_answer(query_nat.prompt, model)
-        if compare_answers(nat_result, query_nat.answer, op_type):
-            correct_nat += 1
+    num_samples = 0
+
+    journaled = load_journal(journal_path)
+    journal = None
+    if journal_path is not None:
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        journal = open(journal_path, 'a')
+        if journal.tell() > 0:
+            # terminate a line truncated by a crash
+            journal.write("\n")
+        if len(journaled) > 0:
+            print(f"Resuming from {journal_path}: {len(journaled)} samples already answered")
+
+    def from_journal(idx: int, query_syn: PromptAndCheck, query_nat: PromptAndCheck) -> dict | None:
+        record = journaled.get(idx)
+        if record is not None and record["syn"]["prompt"] == query_syn.prompt and record["nat"]["prompt"] == query_nat.prompt:
+            return record
+        return None
+
+    def make_record(idx: int, query_syn: PromptAndCheck, query_nat: PromptAndCheck, syn_answer: tuple[str, str], nat_answer: tuple[str, str]) -> dict:
+        syn_result, syn_whole_answer = syn_answer
+        nat_result, nat_whole_answer = nat_answer
 
         # Log All
         syn_log = LogInfo(
@@ -278,21 +420,97 @@ def experiment(samples: list[Sample], model: str, op_type: OperationType):
             is_correct=nat_result == query_nat.answer
         )
 
-        g_syn_logs.append(syn_log)
-        g_nat_logs.append(nat_log)
-
-    print(f"Correct Natural: {correct_nat}/{len(samples)}")
-    print(f"Correct Syntax: {correct_syn}/{len(samples)}")
-
-    return correct_nat/len(samples), correct_syn/len(samples)
+        record = {
+            "idx": idx,
+            "syn": syn_log.model_dump(),
+            "nat": nat_log.model_dump(),
+            "correct_syn": compare_answers(syn_result, query_syn.answer, op_type),
+            "correct_nat": compare_answers(nat_result, query_nat.answer, op_type)
+        }
+        if journal is not None:
+            journal.write(json.dumps(record) + "\n")
+            journal.flush()
+        return record
+
+    def wait_record(idx: int, query_syn: PromptAndCheck, query_nat: PromptAndCheck, syn_future, nat_future) -> dict:
+        return make_record(idx, query_syn, query_nat, syn_future.result(), nat_future.result())
+
+    def collect(record: dict):
+        nonlocal correct_nat, correct_syn, num_samples
+        num_samples += 1
+        correct_syn += record["correct_syn"]
+        correct_nat += record["correct_nat"]
+        if log_writer is not None:
+            log_writer.write_sample(record)
+        if tracker is not None:
+            tracker.log_sample(record)
+
+    # Queries are formatted in the order of the samples, so the random choices in format_query
+    # are the same as in a sequential run, also for the samples found in the journal.
+    try:
+        if batch_size > 1:
+            queries = [(idx, query_syn, query_nat) for idx, (query_syn, query_nat) in enumerate(queries)]
+            records = {idx: from_journal(idx, query_syn, query_nat) for idx, query_syn, query_nat in queries}
+            to_query = [(idx, query_syn, query_nat) for idx, query_syn, query_nat in queries if records[idx] is None]
+            # prompts 2*i and 2*i+1 are the syn and nat prompts of to_query[i]
+            prompts = [query.prompt for _, query_syn, query_nat in to_query for query in [query_syn, query_nat]]
+            answers = [None] * len(prompts)
+            for positions, batch_answers in get_answers_batched(prompts, model, batch_size):
+                for position, answer in zip(positions, batch_answers):
+                    answers[position] = answer
+                    i = position // 2
+                    if answers[2*i] is not None and answers[2*i+1] is not None:
+                        records[to_query[i][0]] = make_record(*to_query[i], answers[2*i], answers[2*i+1])
+
+            for idx, _, _ in queries:
+                collect(records[idx])
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                pending = deque()
+                for idx, (query_syn, query_nat) in enumerate(queries):
+                    record = from_journal(idx, query_syn, query_nat)
+                    if record is not None:
+                        pending.append(partial(lambda record: record, record))
+                    else:
+                        pending.append(partial(wait_record, idx, query_syn, query_nat,
+                                               executor.submit(get_answer, query_syn.prompt, model),
+                                               executor.submit(get_answer, query_nat.prompt, model)))
+                    if len(pending) >= concurrency:
+                        collect(pending.popleft()())
+
+                while pending:
+                    collect(pending.popleft()())
+    finally:
+        if journal is not None:
+            journal.close()
+
+    print(f"Correct Natural: {correct_nat}/{num_samples}")
+    print(f"Correct Syntax: {correct_syn}/{num_samples}")
+
+    return correct_nat/num_samples, correct_syn/num_samples
+
+def compile_object_substitution(object_map: dict, prefix: str = "obj-"):
+    """
+    Returns a function that replaces prefix + i with object_map[i] in a string, in a single pass.
+    The longest ids are tried first, so that obj-10 is not read as obj-1 followed by 0.
+    """
+    names = {str(i): name for i, name in object_map.items()}
+    if len(names) == 0:
+        return lambda string: string
+    ids = sorted(names, key=len, reverse=True)
+    pattern = re.compile(re.escape(prefix) + "(" + "|".join(map(re.escape, ids)) + ")")
+    return partial(pattern.sub, lambda match: names[match[1]])
 
 def substitute_objects(string: str, prefix="obj-"):
-    for i in g_object_map:
-        string = string.replace(prefix + str(i), g_object_map[i])
-
-    return string
-
-def format_query(sample: Sample, op_type: OperationType) -> tuple[PromptAndCheck, PromptAndCheck]:
+    substitute = g_object_substitutions.get(prefix)
+    if substitute is None:
+        substitute = g_object_substitutions[prefix] = compile_object_substitution(g_object_map, prefix)
+    return substitute(string)
+
+def format_query(sample: Sample, op_type: OperationType, rng: random.Random = None) -> tuple[PromptAndCheck, PromptAndCheck]:
+    """rng:random.Random, draws the asked variables when there is a choice, the random module if None."""
+    if rng is None:
+        rng = random
     match op_type:
         case OperationType.kim_schuster:
             first_key = list(sample.label_syn.keys())[0]
@@ -311,14 +529,14 @@ def format_query(sample: Sample, op_type: OperationType) -> tuple[PromptAndCheck
                     PromptAndCheck(prompt=prompt_nat, answer=f"{', '.join(sample.label_nat[first_key])}"))
 
         case OperationType.straight_line:
-            var_name = random.choice(list(sample.label_syn.keys()))
+            var_name = rng.choice(list(sample.label_syn.keys()))
             question = prompt.StraightLine.questions_syn[0].format(varname=var_name)
             prompt_syn = prompt.StraightLine.user_cot.format(prefix="Here's some code:",
                                                             problem=sample.syn,
                                                             question=question)
             
-            agent_name = random.choice(list(sample.label_nat.keys()))
-            object_name = random.choice(list(sample.label_nat[agent_name].keys()))
+            agent_name = rng.choice(list(sample.label_nat.keys()))
+            object_name = rng.choice(list(sample.label_nat[agent_name].keys()))
             question = prompt.StraightLine.questions_nat[0].format(varname=object_name, agentname=agent_name)
             prompt_nat = prompt.StraightLine.user_cot.format(prefix="",
                                                             problem=sample.nat,
@@ -329,13 +547,13 @@ def format_query(sample: Sample, op_type: OperationType) -> tuple[PromptAndCheck
                     PromptAndCheck(prompt=prompt_nat, answer=substitute_objects(str(sample.label_nat[agent_name][object_name]))))
 
         case OperationType.critical_path:
-            var_name = random.choice(list(sample.label_syn.keys()))
+            var_name = rng.choice(list(sample.label_syn.keys()))
             question = prompt.CriticalPath.questions_syn[0].format(varname=var_name)
             prompt_syn = prompt.CriticalPath.user_cot.format(prefix="Here's some code:",
                                                             problem=sample.syn,
                                                             question=question)
             
-            agent_name = random.choice(list(sample.label_nat.keys()))
+            agent_name = rng.choice(list(sample.label_nat.keys()))
             question = prompt.CriticalPath.questions_nat[0].format(agentname=agent_name)
             prompt_nat = prompt.CriticalPath.user_cot.format(prefix="",
                                                             problem=sample.nat,
@@ -400,12 +618,48 @@ def format_query(sample: Sample, op_type: OperationType) -> tuple[PromptAndCheck
         case _:
             raise ValueError("Operation Type not supported")
 
+def get_generation_params(model: str) -> dict:
+    """The config of the model that the responses depend on, part of the cache keys."""
+    return {k: v for k, v in utils.load_config().get(model, {}).items() if k not in g_non_generation_params}
+
 def get_answer(prompt: str, model: str):
     @backoff.on_exception(backoff.expo, Exception, max_time=600)
     def query_engine(prompt: str):
         return utils.queryLLM(prompt, model)
 
-    answer = query_engine(prompt)
+    params = get_generation_params(model)
+    answer = g_cache.get(model, prompt, params) if g_cache is not None else None
+    if answer is None:
+        answer = query_engine(prompt)
+        if g_cache is not None:
+            g_cache.put(model, prompt, answer, params)
+    return extract_answer(answer)
+
+def get_answers_batched(prompts: list[str], model: str, batch_size: int):
+    """
+    Queries the model with batches of at most batch_size prompts of similar length, so that little
+    padding is needed. Yields, for each batch, the positions of its prompts in `prompts` and their answers.
+    """
+    @backoff.on_exception(backoff.expo, Exception, max_time=600)
+    def query_engine(prompts: list[str]):
+        return utils.queryLLM_batch(prompts, model)
+
+    params = get_generation_params(model)
+    cached = [g_cache.get(model, prompt, params) if g_cache is not None else None for prompt in prompts]
+    for position, answer in enumerate(cached):
+        if answer is not None:
+            yield [position], [extract_answer(answer)]
+
+    to_query = sorted([i for i, answer in enumerate(cached) if answer is None], key=lambda i: len(prompts[i]), reverse=True)
+    for start in range(0, len(to_query), batch_size):
+        positions = to_query[start:start+batch_size]
+        answers = query_engine([prompts[i] for i in positions])
+        if g_cache is not None:
+            for i, answer in zip(positions, answers):
+                g_cache.put(model, prompts[i], answer, params)
+        yield positions, [extract_answer(answer) for answer in answers]
+
+def extract_answer(answer: str) -> tuple[str, str]:
     # print(answer)
     # now extract content in between the last occurrence of answer tags
     start = answer.rfind("<answer>")
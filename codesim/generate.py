@@ -0,0 +1,106 @@
+"""
+Generates the datasets of problem.py for a grid of configurations, as generate_data.ipynb does.
+
+Each configuration and batch is a job with its own seed, derived from --seed and from the job
+(problem, parameters, batch), so the output of a job does not depend on the other jobs, nor on
+the number of workers. Samples are written as they are generated, and the jobs whose file
+already exists are skipped, so an interrupted run can be started again with the same command.
+
+Example, the StraightLine datasets in ./data:
+    python3 -m codesim.generate StraightLine --grid n_ops=10,20,30,40,50 n_vars=3 n_instances=2
+"""
+
+import argparse
+import ast
+import hashlib
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .problem import StraightLine, CriticalPath, ParallelPaths, Loops, Sort
+
+g_problems = {
+    "StraightLine": StraightLine,
+    "CriticalPath": CriticalPath,
+    "ParallelPaths": ParallelPaths,
+    "Loops": Loops,
+    "Sort": Sort
+}
+
+
+def parse_grid(grid: list[str]) -> list[dict]:
+    """Returns all the combinations of the parameters given as name=value1,value2,..."""
+    names, values = [], []
+    for param in grid:
+        name, _, param_values = param.partition("=")
+        if not param_values:
+            raise ValueError(f"Parameter {param} is not in the form name=value1,value2,...")
+        names.append(name)
+        values.append([parse_value(v) for v in param_values.split(",")])
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def parse_value(value: str):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def get_job_seed(seed: int, problem: str, params: dict, batch: int) -> int:
+    payload = json.dumps([seed, problem, params, batch], sort_keys=True)
+    return int.from_bytes(hashlib.sha256(payload.encode("utf-8")).digest()[:8], "little")
+
+
+def make_problem(problem: str, params: dict, output_dir: str):
+    gen = g_problems[problem](**params)
+    gen.basepath = os.path.join(output_dir, problem) + "/"
+    return gen
+
+
+def run_job(problem: str, params: dict, batch: int, seed: int, n_programs: int, output_dir: str) -> str:
+    """Generates one batch of a configuration and returns the path of its file."""
+    random.seed(seed)
+    gen = make_problem(problem, params, output_dir)
+    return gen.generate_to_file(n_programs=n_programs, suffix=f"batch-{batch}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates the datasets of a problem for a grid of configurations.")
+    parser.add_argument('problem', choices=list(g_problems), help='Problem to generate')
+    parser.add_argument('--grid', nargs='+', required=True, type=str, help='Parameters of the problem, as name=value1,value2,... (all the combinations are generated)')
+    parser.add_argument('--n-programs', default=30, type=int, help='Number of samples in each file')
+    parser.add_argument('--batches', default=3, type=int, help='Number of files generated for each configuration')
+    parser.add_argument('--seed', default=0, type=int, help='Seed from which the seed of each file is derived')
+    parser.add_argument('--workers', default=1, type=int, help='Number of processes generating the files')
+    parser.add_argument('--output-dir', default='./data', type=str, help='The files are saved in <output-dir>/<problem>/')
+    args = parser.parse_args()
+
+    jobs = []
+    for params in parse_grid(args.grid):
+        for batch in range(1, args.batches + 1):
+            path = make_problem(args.problem, params, args.output_dir).get_path(suffix=f"batch-{batch}")
+            if os.path.exists(path):
+                print(f"Skipping {path}...")
+                continue
+            seed = get_job_seed(args.seed, args.problem, params, batch)
+            jobs.append((args.problem, params, batch, seed, args.n_programs, args.output_dir))
+    print(f"Generating {len(jobs)} files...")
+
+    start = time.perf_counter()
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(run_job, *job) for job in jobs]
+            for future in as_completed(futures):
+                print(f"Saved {future.result()}")
+    else:
+        for job in jobs:
+            print(f"Saved {run_job(*job)}")
+    print(f"Generated {len(jobs)} files in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
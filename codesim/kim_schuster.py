@@ -1,17 +1,22 @@
 import argparse
 import csv
-import copy
+import gc
 import random
 import json
 import os
 import re
 import numpy as np
 from .my_types import Sample
+from .dataset import write_compact
 
 from pydantic.json import pydantic_encoder
 from numpy.random import poisson
 
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
+from math import comb, exp, factorial
 
 
 # Possible operations
@@ -35,6 +40,9 @@ _OPERATIONS_DICT_ALT = {
 
 g_set_map = {}
 
+# Number of operations sampled and of draws made by sample_operation, to measure its rejections
+g_sampler_stats = Counter()
+
 _ALT_BOX_NOUN = "Container"
 _SYN_NOUN = "x"
 
@@ -42,6 +50,9 @@ _MODIFIERS = ["big", "small", "blue", "green", "red", "yellow"]
 
 _SPLITS_PROP = {"train": 0.33, "dev": 0.33, "test": 0.34}
 
+# _BYTE_BITS[b] are the positions of the bits set in the byte b, see BitsetWorldState
+_BYTE_BITS = [tuple(i for i in range(8) if b >> i & 1) for b in range(256)]
+
 
 class WorldState:
     """f
@@ -78,6 +89,8 @@ class WorldState:
         self.max_items_per_box = max_items_per_box
         self.expected_num_items_per_box = expected_num_items_per_box
         self.zero_shot = zero_shot
+        # contents of the boxes in the last snapshot, None for the boxes changed since then
+        self._frozen_boxes = [None for _ in range(num_boxes)]
 
         if contents is not None:
             for i, b in enumerate(contents):
@@ -107,6 +120,7 @@ class WorldState:
         Raises:
             KeyError: Raised if non-exstent object is removed.
         """
+        self._frozen_boxes[box] = None
         if isinstance(content, (list, set)):
             for c in content:
                 if c not in self.boxes[box]:
@@ -119,6 +133,7 @@ class WorldState:
             self.void.add(content)
 
     def add_to_box(self, box, content):
+        self._frozen_boxes[box] = None
         if isinstance(content, list) or isinstance(content, set):
             for c in content:
                 if c not in self.all_objects:
@@ -148,6 +163,8 @@ class WorldState:
             self.boxes[box].add(content)
 
     def move_to_box(self, from_box, to_box, content):
+        self._frozen_boxes[from_box] = None
+        self._frozen_boxes[to_box] = None
         if isinstance(content, list) or isinstance(content, set):
             for c in content:
                 if c not in self.boxes[from_box]:
@@ -178,15 +195,46 @@ class WorldState:
     def empty_box(self, box):
         raise NotImplementedError
 
-    @staticmethod
+    def box_size(self, box):
+        """Returns the number of objects in Box #box."""
+        return len(self.boxes[box])
+
+    def box_contents(self, box):
+        """Returns the objects in Box #box."""
+        return self.boxes[box]
+
+    def snapshot(self):
+        """Returns an immutable copy of the world state (see FrozenWorldState).
+
+        The boxes that did not change since the previous snapshot share their contents with it,
+        so a snapshot per operation costs the boxes changed by the operation, instead of a
+        deepcopy of all the boxes and of the void.
+        """
+        for i, box in enumerate(self.boxes):
+            if self._frozen_boxes[i] is None:
+                # built from the list of the objects like copy.deepcopy does, so that the objects
+                # are iterated in the same order (it sets the order of the labels and of the syn text)
+                self._frozen_boxes[i] = frozenset(list(box))
+
+        state = FrozenWorldState.__new__(FrozenWorldState)
+        state.boxes = list(self._frozen_boxes)
+        state.all_objects = self.all_objects
+        state.num_boxes = self.num_boxes
+        state.max_items_per_box = self.max_items_per_box
+        state.expected_num_items_per_box = self.expected_num_items_per_box
+        state.zero_shot = self.zero_shot
+        return state
+
+    @classmethod
     def sample_initial_world_state(
+        cls,
         all_objects,
         num_boxes,
         max_items_per_box,
         expected_num_items_per_box,
         zero_shot=False,
     ):
-        s = WorldState(
+        s = cls(
             all_objects,
             num_boxes,
             max_items_per_box,
@@ -250,7 +298,8 @@ class WorldState:
         final_char = (
             "." if individual else ""
         )  # add period if not part of an enumeration
-        if len(self.boxes[box]) == 0:
+        contents = self.box_contents(box)
+        if len(contents) == 0:
             if alt_description:
                 return f"there is nothing in {box_noun} {box_name}{final_char}"
             else:
@@ -259,13 +308,13 @@ class WorldState:
                 else:
                     return f"{box_noun} {box_name} is empty{final_char}"
                 # return f"{first_char}he {box_name} box is empty{final_char}"
-        elif len(self.boxes[box]) == 1:
+        elif len(contents) == 1:
             if alt_description:
-                return f"the {list(self.boxes[box])[0]} is in {box_noun} {box_name}{final_char}"
+                return f"the {list(contents)[0]} is in {box_noun} {box_name}{final_char}"
             else:
-                return f"{box_noun} {box_name} contains the {list(self.boxes[box])[0]}{final_char}"
+                return f"{box_noun} {box_name} contains the {list(contents)[0]}{final_char}"
         else:
-            box_contents = " and ".join([f"the {c}" for c in sorted(self.boxes[box])])
+            box_contents = " and ".join([f"the {c}" for c in sorted(contents)])
             if alt_description:
                 return f"{box_contents} are in {box_noun} {box_name}{final_char}"
             else:
@@ -275,10 +324,11 @@ class WorldState:
             self, box
     ):
         """Gives a code description of the content in the box"""
-        if len(self.boxes[box]) == 0:
+        contents = self.box_contents(box)
+        if len(contents) == 0:
             return f"{_SYN_NOUN}{box}" + " = set()\n"
         else:
-            return f"{_SYN_NOUN}{box}" + " = {" + f"{', '.join(str(g_set_map[x]) for x in self.boxes[box])}" + "}\n"
+            return f"{_SYN_NOUN}{box}" + " = {" + f"{', '.join(str(g_set_map[x]) for x in contents)}" + "}\n"
 
     def __eq__(self, o):
         for box1, box2 in zip(self.boxes, o.boxes):
@@ -298,23 +348,179 @@ class WorldState:
         """ Returns a dictionary of all the contents of the boxes in the world state """
         if box is None:
             return {
-                x: list([g_set_map[y] for y in self.boxes[x]]) for x in range(self.num_boxes)
+                x: list([g_set_map[y] for y in self.box_contents(x)]) for x in range(self.num_boxes)
             }
         else:
             return {
-                box: list([g_set_map[y] for y in self.boxes[box]]) 
+                box: list([g_set_map[y] for y in self.box_contents(box)]) 
             }
     def representation(self, box=None):
         """ Returns a dictionary of all the contents of the boxes in the world state """
         if box is None:
             return {
-                x: list(self.boxes[x]) for x in range(self.num_boxes)
+                x: list(self.box_contents(x)) for x in range(self.num_boxes)
             }
         else:
             return {
-                box: list(self.boxes[box])
+                box: list(self.box_contents(box))
             }
 
+
+class FrozenWorldState(WorldState):
+    """
+    An immutable snapshot of a WorldState, returned by WorldState.snapshot.
+    """
+
+    @property
+    def void(self):
+        # not stored, as it is as large as the set of all the objects
+        return set(self.all_objects).difference(*self.boxes)
+
+    def snapshot(self):
+        return self
+
+    def remove_from_box(self, box, content):
+        raise TypeError("A snapshot of a WorldState cannot be changed")
+
+    def add_to_box(self, box, content):
+        raise TypeError("A snapshot of a WorldState cannot be changed")
+
+    def move_to_box(self, from_box, to_box, content):
+        raise TypeError("A snapshot of a WorldState cannot be changed")
+
+
+class BitsetWorldState(WorldState):
+    """
+    A WorldState where each box, and the void, is an integer bitmask: bit i is set if the object
+    with id i in g_set_map is in the box. Adding, moving and removing objects, comparing and
+    hashing states are integer operations, and the objects of a box are listed in the order of
+    their ids. g_set_map must have an id for each object.
+    """
+
+    def __init__(
+        self,
+        all_objects,
+        num_boxes,
+        max_items_per_box,
+        expected_num_items_per_box,
+        contents=None,
+        zero_shot=False,
+    ):
+        # objects[i] is the object with id i
+        self.objects = sorted(all_objects, key=lambda obj: g_set_map[obj])
+        self.boxes = [0 for _ in range(num_boxes)]
+        self.all_objects = all_objects
+        self._void = (1 << len(self.objects)) - 1
+        self.num_boxes = num_boxes
+        self.max_items_per_box = max_items_per_box
+        self.expected_num_items_per_box = expected_num_items_per_box
+        self.zero_shot = zero_shot
+
+        if contents is not None:
+            for i, b in enumerate(contents):
+                if self.max_items_per_box > 0 and len(b) > self.max_items_per_box:
+                    raise ValueError(
+                        f"Attempted to add more than MAX_ITEMS_PER_BOX \
+                         (={self.max_items_per_box}) items to box #{i}"
+                    )
+                mask = self._mask(b)
+                self._void &= ~mask
+                self.boxes[i] |= mask
+
+    def __str__(self):
+        ret = "Boxes:" + str([self.box_contents(b) for b in range(self.num_boxes)]) + "\n"
+        ret += "Void:" + str(self.void)
+        return ret
+
+    def __hash__(self):
+        return hash(tuple(self.boxes))
+
+    def _mask(self, content):
+        """Returns the bitmask of an object or of a list/set of objects."""
+        if not isinstance(content, (list, set)):
+            content = [content]
+        mask = 0
+        for c in content:
+            if c not in g_set_map:
+                raise KeyError(f"{c} is not a valid object!")
+            mask |= 1 << g_set_map[c]
+        return mask
+
+    def _objects(self, mask):
+        """Returns the objects in a bitmask, in the order of their ids."""
+        objects = []
+        if mask.bit_count() <= 8:
+            # boxes have a few objects, a bit at a time
+            while mask:
+                low = mask & -mask
+                objects.append(self.objects[low.bit_length() - 1])
+                mask ^= low
+            return objects
+
+        offset = 0
+        # the void has most of the bits set, a byte at a time
+        while mask:
+            byte = mask & 0xFF
+            if byte:
+                objects.extend([self.objects[offset + i] for i in _BYTE_BITS[byte]])
+            mask >>= 8
+            offset += 8
+        return objects
+
+    @property
+    def void(self):
+        return self._objects(self._void)
+
+    def box_size(self, box):
+        return self.boxes[box].bit_count()
+
+    def box_contents(self, box):
+        return self._objects(self.boxes[box])
+
+    def remove_from_box(self, box, content):
+        mask = self._mask(content)
+        if self.boxes[box] & mask != mask:
+            raise KeyError(f"{content} not in box #{box + 1}")
+        self.boxes[box] &= ~mask
+        self._void |= mask
+
+    def add_to_box(self, box, content):
+        mask = self._mask(content)
+        if mask & ~self._void:
+            raise KeyError(f"{content} is already in another box!")
+        if (
+            self.max_items_per_box > 0
+            and (mask.bit_count() + self.boxes[box].bit_count()) > self.max_items_per_box
+        ):
+            raise ValueError(
+                f"Attempted to add more than MAX_ITEMS_PER_BOX \
+                (={self.max_items_per_box}) items to box #{box}"
+            )
+        self._void &= ~mask
+        self.boxes[box] |= mask
+
+    def move_to_box(self, from_box, to_box, content):
+        mask = self._mask(content)
+        if self.boxes[from_box] & mask != mask:
+            raise KeyError(f"{content} not in box #{from_box}")
+        if (
+            self.max_items_per_box > 0
+            and (mask.bit_count() + self.boxes[to_box].bit_count()) > self.max_items_per_box
+        ):
+            raise ValueError(
+                f"Attempted to add more than MAX_ITEMS_PER_BOX \
+                (={self.max_items_per_box}) items to box #{to_box}"
+            )
+        self.boxes[from_box] &= ~mask
+        self.boxes[to_box] |= mask
+
+    def snapshot(self):
+        """Returns a copy of the world state, the boxes are integers and are not copied."""
+        state = BitsetWorldState.__new__(BitsetWorldState)
+        state.__dict__.update(self.__dict__)
+        state.boxes = list(self.boxes)
+        return state
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -413,6 +619,35 @@ def parse_args():
         help="If set, use the operation 'Move the contents' instead of enumerating the contents when all the contents are being moved.",
     )
 
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="set",
+        choices=["set", "bitset"],
+        help="Representation of the boxes: Python sets of objects, or integer bitmasks (faster, the objects are listed in the order of their ids).",
+    )
+
+    parser.add_argument(
+        "--sampler",
+        type=str,
+        default="rejection",
+        choices=["rejection", "feasible"],
+        help="How operations are sampled: draw and retry until one can be applied, or draw only among the ones that can be applied.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes sampling the operation sequences. The output depends on the seed and on the number of workers.",
+    )
+
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="If set, the datasets are saved in the compact format of codesim.dataset, where each operation sequence is stored once.",
+    )
+
     return parser.parse_args()
 
 
@@ -540,14 +775,11 @@ def example_to_t5(ex, zero_shot=False, modifier_map=None, pragmatic=False):
     # replace non-modified object descriptions
     # with modified object descriptions
     if modifier_map is not None:
-        for key, val in modifier_map.items():
-            pattern = r"(\sthe\s)" + key + r"([,.\s]|$)"
-            repl = r"\1" + val + r"\2"
-            if pragmatic:
-                sentences[0] = re.sub(pattern, repl, sentences[0])
-                sentences[-2] = re.sub(pattern, repl, sentences[-2])
-            else:
-                ex = re.sub(pattern, repl, ex)
+        if pragmatic:
+            sentences[0] = substitute_modifiers(sentences[0], modifier_map)
+            sentences[-2] = substitute_modifiers(sentences[-2], modifier_map)
+        else:
+            ex = substitute_modifiers(ex, modifier_map)
 
     if not pragmatic:
         sentences = ex.split(".")
@@ -576,6 +808,187 @@ def example_to_t5(ex, zero_shot=False, modifier_map=None, pragmatic=False):
     }
 
 
+def substitute_modifiers(text, modifier_map):
+    """Replaces the object names in text with the modified object names of modifier_map."""
+    for key, val in modifier_map.items():
+        pattern = r"(\sthe\s)" + key + r"([,.\s]|$)"
+        repl = r"\1" + val + r"\2"
+        text = re.sub(pattern, repl, text)
+    return text
+
+
+def sample_operation(world_state, operations, box_names, all_contents_operation=False):
+    """Samples an operation and applies it to world_state.
+
+    An operation and a box are drawn uniformly, the draw is repeated until the
+    operation can be applied.
+
+    Returns:
+        op, box1, box2, contents, all_contents: The operation, as in describe_operation.
+    """
+    op = None
+    box1 = None
+    box2 = None
+    contents = []
+    all_contents = False
+    while True:
+        g_sampler_stats["draws"] += 1
+        # Sample an operation (each operation has different arity)
+        op = random.choice(operations)
+        box1 = random.choice(box_names)
+        all_contents = False
+        if op == "empty":
+            try:
+                world_state.empty_box(box1)
+                break
+            except (ValueError, KeyError):
+                continue
+        elif op == "move":
+            if world_state.box_size(box1) < 1:
+                continue
+            box2 = random.choice(box_names[0:box1] + box_names[box1 + 1 :])
+            contents = random_nonempty_subset(world_state.box_contents(box1))
+            if all_contents_operation and len(contents) == world_state.box_size(box1):
+                all_contents = True
+
+            try:
+                world_state.move_to_box(box1, box2, contents)
+                break
+            except (ValueError, KeyError):
+                continue
+        elif op == "put":
+            exp_value = max(1, int(world_state.expected_num_items_per_box / 2))
+            no_items = poisson(exp_value)
+            if (
+                world_state.max_items_per_box > 0
+                and (no_items + world_state.box_size(box1))
+                > world_state.max_items_per_box
+            ) or no_items < 1:
+                continue
+
+            contents = random.sample(list(world_state.void), no_items)
+
+            try:
+                world_state.add_to_box(box1, contents)
+                break
+            except (ValueError, KeyError):
+                continue
+        elif op == "remove":
+            if world_state.box_size(box1) < 1:
+                continue
+
+            contents = random_nonempty_subset(world_state.box_contents(box1))
+            try:
+                world_state.remove_from_box(box1, contents)
+                break
+            except (ValueError, KeyError):
+                continue
+        else:
+            continue
+
+    return op, box1, box2, contents, all_contents
+
+
+@lru_cache(maxsize=None)
+def _nonempty_subset_size_weights(n, max_size):
+    """Cumulative probabilities of the sizes 1..max_size of a random_nonempty_subset of n objects."""
+    return list(accumulate(comb(n, k) / (2**n - 1) for k in range(1, max_size + 1)))
+
+
+@lru_cache(maxsize=None)
+def _poisson_weights(exp_value, max_value):
+    """Cumulative probabilities of the values 1..max_value of a Poisson draw."""
+    return list(accumulate(exp(-exp_value) * exp_value**k / factorial(k) for k in range(1, max_value + 1)))
+
+
+@lru_cache(maxsize=None)
+def _feasible_operations(operations, size_counts, num_objects, max_items, exp_value):
+    """
+    Returns the classes of operations that can be applied to boxes with the given sizes, and their
+    cumulative weights: the probability that sample_operation draws and accepts an operation of
+    the class, up to a constant. A class is (op, size of box1, size of box2, max number of objects),
+    the operations of a class have the same probability.
+
+    size_counts: tuple of (size, number of boxes with that size), which makes few distinct keys.
+    """
+    num_boxes = sum(count for _, count in size_counts)
+    num_void = num_objects - sum(size * count for size, count in size_counts)
+    candidates = []
+    weights = []
+    # in a fixed order, so that the draws depend only on the seed
+    for op in dict.fromkeys(operations):
+        op_weight = operations.count(op)
+        for size, count in size_counts:
+            if op == "remove" and size > 0:
+                candidates.append((op, size, None, size))
+                weights.append(op_weight * count)
+            elif op == "move" and size > 0:
+                for size2, count2 in size_counts:
+                    max_size = size if max_items <= 0 else min(size, max_items - size2)
+                    num_pairs = count * (count2 if size2 != size else count - 1)
+                    if num_pairs == 0 or max_size < 1:
+                        continue
+                    candidates.append((op, size, size2, max_size))
+                    weights.append(op_weight * num_pairs * _nonempty_subset_size_weights(size, max_size)[-1] / (num_boxes - 1))
+            elif op == "put":
+                max_value = num_void if max_items <= 0 else min(num_void, max_items - size)
+                if max_value < 1:
+                    continue
+                candidates.append((op, size, None, max_value))
+                weights.append(op_weight * count * _poisson_weights(exp_value, max_value)[-1])
+    return candidates, list(accumulate(weights))
+
+
+def sample_feasible_operation(world_state, operations, box_names, all_contents_operation=False):
+    """Samples an operation and applies it to world_state, without rejections.
+
+    Each (operation, box1, box2) is drawn with the probability that sample_operation
+    draws and accepts it, given the sizes of the boxes; the number of objects that are
+    moved or put is drawn from the binomial/Poisson distribution of sample_operation,
+    truncated to the values that fit. The feasible operations depend only on how many
+    boxes have each size, and are computed once for each of these counts.
+
+    Returns:
+        op, box1, box2, contents, all_contents: The operation, as in describe_operation.
+    """
+    boxes_by_size = {}
+    for box in box_names:
+        boxes_by_size.setdefault(world_state.box_size(box), []).append(box)
+    candidates, cum_weights = _feasible_operations(
+        tuple(operations),
+        tuple(sorted((size, len(boxes)) for size, boxes in boxes_by_size.items())),
+        len(world_state.all_objects),
+        world_state.max_items_per_box,
+        max(1, int(world_state.expected_num_items_per_box / 2)),
+    )
+    if len(candidates) == 0:
+        raise ValueError("No operation can be applied to the world state")
+
+    g_sampler_stats["draws"] += 1
+    op, size, size2, max_count = random.choices(candidates, cum_weights=cum_weights)[0]
+    box1 = random.choice(boxes_by_size[size])
+    box2 = None
+    all_contents = False
+    if op == "remove":
+        contents = random_nonempty_subset(world_state.box_contents(box1))
+        world_state.remove_from_box(box1, contents)
+    elif op == "move":
+        box2 = random.choice([box for box in boxes_by_size[size2] if box != box1])
+        size_weights = _nonempty_subset_size_weights(size, max_count)
+        num_moved = random.choices(range(1, max_count + 1), cum_weights=size_weights)[0]
+        contents = set(random.sample(list(world_state.box_contents(box1)), num_moved))
+        if all_contents_operation and num_moved == size:
+            all_contents = True
+        world_state.move_to_box(box1, box2, contents)
+    else:
+        exp_value = max(1, int(world_state.expected_num_items_per_box / 2))
+        no_items = random.choices(range(1, max_count + 1), cum_weights=_poisson_weights(exp_value, max_count))[0]
+        contents = random.sample(list(world_state.void), no_items)
+        world_state.add_to_box(box1, contents)
+
+    return op, box1, box2, contents, all_contents
+
+
 def sample_operation_sequences(
     world_state: WorldState,
     operations,
@@ -583,6 +996,7 @@ def sample_operation_sequences(
     num_operations,
     generate_alternative_forms=False,
     all_contents_operation=False,
+    sampler="rejection",
 ):
     """Performs operation sequence sampling.
 
@@ -593,10 +1007,11 @@ def sample_operation_sequences(
         num_operations: Total number of operations in a single sequence.
         generate_alternative_forms: Whether to generate altenatively phrased descriptions.
         all_contents_operation: Whether to generate operations of the form "Move the contents from Box X to Box Y."
+        sampler: "rejection" (sample_operation) or "feasible" (sample_feasible_operation).
 
     Returns:
         operation_sequence: A list of sampled operations.
-        world_states: A list of WorldStates after each sampled operation.
+        world_states: A list of snapshots of the WorldState after each sampled operation (see WorldState.snapshot).
         alt_operation_sequence: A list of alternatively phrased operations.
     """
     operation_sequence = []
@@ -605,7 +1020,7 @@ def sample_operation_sequences(
 
     # Convert initial world state into naturalistic language
     # and append to operation_sequence
-    world_states.append(copy.deepcopy(world_state))
+    world_states.append(world_state.snapshot())
     if generate_alternative_forms:
         operation_sequence.append(
             world_state.state_description(
@@ -617,68 +1032,13 @@ def sample_operation_sequences(
     syn_sequence.append(world_state.syn_state_description())
 
     for _ in range(num_operations):
-        op = None
-        box1 = None
-        box2 = None
-        contents = []
-        all_contents = False
-        while True:
-            # Sample an operation (each operation has different arity)
-            op = random.choice(operations)
-            box1 = random.choice(box_names)
-            all_contents = False
-            if op == "empty":
-                try:
-                    world_state.empty_box(box1)
-                    break
-                except (ValueError, KeyError):
-                    continue
-            elif op == "move":
-                if len(world_state.boxes[box1]) < 1:
-                    continue
-                box2 = random.choice(box_names[0:box1] + box_names[box1 + 1 :])
-                contents = random_nonempty_subset(world_state.boxes[box1])
-                if all_contents_operation and len(contents) == len(
-                    world_state.boxes[box1]
-                ):
-                    all_contents = True
-
-                try:
-                    world_state.move_to_box(box1, box2, contents)
-                    break
-                except (ValueError, KeyError):
-                    continue
-            elif op == "put":
-                exp_value = max(1, int(world_state.expected_num_items_per_box / 2))
-                no_items = poisson(exp_value)
-                if (
-                    world_state.max_items_per_box > 0
-                    and (no_items + len(world_state.boxes[box1]))
-                    > world_state.max_items_per_box
-                ) or no_items < 1:
-                    continue
-
-                contents = random.sample(list(world_state.void), no_items)
-
-                try:
-                    world_state.add_to_box(box1, contents)
-                    break
-                except (ValueError, KeyError):
-                    continue
-            elif op == "remove":
-                if len(world_state.boxes[box1]) < 1:
-                    continue
-
-                contents = random_nonempty_subset(world_state.boxes[box1])
-                try:
-                    world_state.remove_from_box(box1, contents)
-                    break
-                except (ValueError, KeyError):
-                    continue
-            else:
-                continue
+        if sampler == "feasible":
+            op, box1, box2, contents, all_contents = sample_feasible_operation(world_state, operations, box_names, all_contents_operation)
+        else:
+            op, box1, box2, contents, all_contents = sample_operation(world_state, operations, box_names, all_contents_operation)
+        g_sampler_stats["operations"] += 1
 
-        world_states.append(copy.deepcopy(world_state))
+        world_states.append(world_state.snapshot())
         alt_description = False
         if generate_alternative_forms:
             alt_description = True
@@ -708,9 +1068,9 @@ def check_state_signature(state, state_signature_set, max_items_per_box=9):
 
     base = max_items_per_box + 1
     state_signature = 0
-    for box in state.boxes:
+    for box in range(state.num_boxes):
         state_signature *= base
-        state_signature += len(box)
+        state_signature += state.box_size(box)
     return state_signature in state_signature_set
 
 
@@ -787,11 +1147,10 @@ def pragmatify(state, operation, modifier_map):
     elif toks[0] == "Put":
         return operation
 
+    # only the boxes are needed, with the modified object names
+    boxes = [state.box_contents(box) for box in range(state.num_boxes)]
     if modifier_map is not None:
-        state = copy.deepcopy(state)
-        state.void = set([modifier_map[obj] for obj in state.void])
-        for i, box in enumerate(state.boxes):
-            state.boxes[i] = set([modifier_map[obj] for obj in box])
+        boxes = [set([modifier_map[obj] for obj in box]) for box in boxes]
 
     if toks[0] == "Move":
         contents_descr = " ".join(toks[1:-6])
@@ -804,7 +1163,7 @@ def pragmatify(state, operation, modifier_map):
     else:
         raise ValueError(f"Unknown operation: {toks[0]}; Operation {operation}")
 
-    non_unique_types = non_unique_object_types(state.boxes[src_box])
+    non_unique_types = non_unique_object_types(boxes[src_box])
 
     contents = [s.replace("the ", "") for s in contents_descr.split(" and ")]
     if modifier_map is not None:
@@ -845,6 +1204,66 @@ def syn_pragmatify(state, operation, modifier_map):
     pass
 
 
+def sample_sequences(args, objects_set, num_sequences):
+    """Samples num_sequences initial world states and their operation sequences.
+
+    Returns:
+        list: (world_states, operation_sequence, syn_sequence) for each sequence.
+    """
+    operations = list(_OPERATIONS_DICT.keys())
+    box_names = list(range(0, args.num_boxes))
+    max_num_operations = (
+        args.num_operations + 10 if args.disjoint_numops else args.num_operations
+    )
+    generate_alt_descriptions = args.alternative_forms != "never"
+    engine = BitsetWorldState if args.engine == "bitset" else WorldState
+
+    sampled_sequences = []
+    for _ in range(num_sequences):
+        initial_world_state = engine.sample_initial_world_state(
+            all_objects=objects_set,
+            num_boxes=args.num_boxes,
+            max_items_per_box=args.max_items_per_box,
+            expected_num_items_per_box=args.expected_num_items_per_box,
+            zero_shot=args.zero_shot,
+        )
+        (
+            operation_sequence,
+            world_states,
+            syn_sequence,
+        ) = sample_operation_sequences(
+            initial_world_state,
+            operations,
+            box_names,
+            max_num_operations,
+            generate_alternative_forms=generate_alt_descriptions,
+            all_contents_operation=args.all_contents_operation,
+            sampler=args.sampler,
+        )
+        sampled_sequences.append(
+            (world_states, operation_sequence, syn_sequence)
+        )
+    return sampled_sequences
+
+
+def sample_sequences_shard(args, objects_set, set_map, seed, num_sequences):
+    """Runs sample_sequences in a worker process, with its own seed.
+
+    Returns:
+        tuple: The sampled sequences and the g_sampler_stats of the worker.
+    """
+    global g_set_map
+    # the object ids of the main process (the worker may have been started with spawn)
+    g_set_map = set_map
+    # the states are not cyclic, while the collections triggered by allocating them take a
+    # good part of the time of sampling and pickling them
+    gc.disable()
+    g_sampler_stats.clear()
+    random.seed(seed)
+    np.random.seed(seed)
+    return sample_sequences(args, objects_set, num_sequences), g_sampler_stats
+
+
 def main(args):
     """
         Main function.
@@ -868,9 +1287,6 @@ def main(args):
         obj_map = disjoint_object_map(objects_set, args.disjoint_object_vocabulary_file)
 
     if not args.rarify:
-        operations = list(_OPERATIONS_DICT.keys())
-        box_names = list(range(0, args.num_boxes))
-
         sampled_sequences = []
 
         # sampling twice as many sequences as requested since there may not be
@@ -881,36 +1297,42 @@ def main(args):
             args.num_operations + 10 if args.disjoint_numops else args.num_operations
         )
 
-        generate_alt_descriptions = args.alternative_forms != "never"
-
-        for _ in range(num_samples):
-            initial_world_state = WorldState.sample_initial_world_state(
-                all_objects=objects_set,
-                num_boxes=args.num_boxes,
-                max_items_per_box=args.max_items_per_box,
-                expected_num_items_per_box=args.expected_num_items_per_box,
-                zero_shot=args.zero_shot,
-            )
-            (
-                operation_sequence,
-                world_states,
-                syn_sequence,
-            ) = sample_operation_sequences(
-                initial_world_state,
-                operations,
-                box_names,
-                max_num_operations,
-                generate_alternative_forms=generate_alt_descriptions,
-                all_contents_operation=args.all_contents_operation,
-            )
-            sampled_sequences.append(
-                (world_states, operation_sequence, syn_sequence)
-            )
+        if args.workers > 1:
+            # shard k samples with its own seed, the shards are merged in order, so the output
+            # depends only on the seed and on the number of workers
+            seeds = [
+                int(seq.generate_state(1)[0])
+                for seq in np.random.SeedSequence(args.seed).spawn(args.workers)
+            ]
+            shard_sizes = [
+                num_samples // args.workers + (k < num_samples % args.workers)
+                for k in range(args.workers)
+            ]
+            # as in the workers, no garbage collections while the states are unpickled
+            gc.disable()
+            try:
+                with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                    shards = executor.map(
+                        sample_sequences_shard,
+                        [args] * args.workers,
+                        [objects_set] * args.workers,
+                        [g_set_map] * args.workers,
+                        seeds,
+                        shard_sizes,
+                    )
+                    for shard_sequences, shard_stats in shards:
+                        sampled_sequences.extend(shard_sequences)
+                        g_sampler_stats.update(shard_stats)
+            finally:
+                gc.enable()
+        else:
+            sampled_sequences = sample_sequences(args, objects_set, num_samples)
 
         print(
             f"finished sampling {num_samples}",
             f"sequences of length {max_num_operations}.",
         )
+        print(f"{g_sampler_stats['draws'] - g_sampler_stats['operations']} rejected draws for {g_sampler_stats['operations']} operations.")
 
         state_signatures_count = (args.max_items_per_box + 1) ** args.num_boxes
         state_signatures_all = list(range(state_signatures_count))
@@ -996,13 +1418,9 @@ def main(args):
             if args.include_modifiers in ["always", split]:
                 modifier_map = make_modifier_map(objects_set, pragmatic=pragmatic)
 
-            prefix = ""
+            nat_parts = []
             syn_prefix = ""
             prev_state = None
-            box_noun = "Box"
-            alt_descriptions = args.alternative_forms in ["always", split]
-            if alt_descriptions:
-                box_noun = _ALT_BOX_NOUN
             numops = [0 for _ in range(args.num_boxes)]
             numops_by_type = [
                 {t: 0 for t in _OPERATIONS_DICT.keys()} for _ in range(args.num_boxes)
@@ -1017,7 +1435,16 @@ def main(args):
 
                 # print(op, syn_op)
 
-                prefix += " " + op
+                # The samples of a step differ only by the box whose description ends the example,
+                # and example_to_t5 drops that sentence: the nat text is the same for all the boxes,
+                # and it is the text of the operations so far without the final '.'.
+                # The modifiers are added to each operation once, as example_to_t5 does on the whole
+                # text (only to the initial description with pragmatic=True).
+                nat_part = " " + op
+                if modifier_map is not None and (j == 0 or not pragmatic):
+                    nat_part = substitute_modifiers(nat_part, modifier_map)
+                nat_parts.append(nat_part)
+                nat = "".join(nat_parts)[:-1].lstrip()
                 syn_prefix += syn_op
                 op_type = op.split()[0].lower()
                 if prev_state is not None and op_type not in numops_by_type[0]:
@@ -1039,13 +1466,7 @@ def main(args):
                         numops[box] += 1
                         numops_by_type[box][op_type] += 1
 
-                    ex = prefix + " " + state.state_description(box, box_noun=box_noun)
-                    out_d = example_to_t5(
-                        ex,
-                        zero_shot=state.zero_shot,
-                        modifier_map=modifier_map,
-                        pragmatic=pragmatic,
-                    )
+                    out_d = {"nat": nat}
                     out_d["label_nat"] = state.representation(box)
                     out_d["syn"] = syn_prefix
                     out_d["label_syn"] = state.syn_representation(box)
@@ -1059,8 +1480,12 @@ def main(args):
 
         i = 1
         for split, size in splits_size.items():
-            with open(f"data/boxes/num_boxes-{initial_world_state.num_boxes}-max_items_per_box-{initial_world_state.max_items_per_box}-batch-{i}.json", "w") as f:
-                json.dump(out_dirs[split], f, indent=4, default=pydantic_encoder)
+            out_path = f"data/boxes/num_boxes-{args.num_boxes}-max_items_per_box-{args.max_items_per_box}-batch-{i}.json"
+            if args.compact:
+                write_compact(out_path, [sample.model_dump() for sample in out_dirs[split]])
+            else:
+                with open(out_path, "w") as f:
+                    json.dump(out_dirs[split], f, indent=4, default=pydantic_encoder)
             i+=1
             assert count_num[split] == size, (split, count_num[split], size)
 
@@ -0,0 +1,157 @@
+"""
+Line-delimited logs of the experiments, logs/<operation>/<dataset>-<model>-<date>.jsonl(.gz).
+
+The first line describes the run, then each answered sample is written (and flushed) as soon as it
+is collected, {"type": "sample", "idx", "syn", "nat", "correct_syn", "correct_nat"} where "syn" and
+"nat" are the LogInfo of the two prompts, and the last line has the accuracies. Nothing is kept in
+memory, and a crashed run keeps the samples answered so far.
+Filter the logs with `python3 -m codesim.logs show <files>`, and convert them to the .txt format
+read by plot.ipynb with `python3 -m codesim.logs txt <files>`.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import zlib
+from typing import Iterator
+
+from .dataset import open_dataset
+
+LOG_FORMATS = ["jsonl", "jsonl.gz", "txt"]
+
+
+class LogWriter:
+    def __init__(self, operation: str, dataset_name: str, model: str, compress: bool = False, basedir: str = "logs"):
+        """
+        Creates logs/<operation>/<dataset_name>-<model>-<date>.jsonl, .jsonl.gz if compress.
+        """
+        directory = os.path.join(basedir, operation)
+        os.makedirs(directory, exist_ok=True)
+        date = datetime.datetime.now().strftime("%mM-%dD-%Hh-%Mm%Ss")
+        extension = ".jsonl.gz" if compress else ".jsonl"
+        self.path = os.path.join(directory, f"{dataset_name}-{model}-{date}{extension}")
+        # runs started in the same second do not overwrite each other's logs
+        i = 1
+        while os.path.exists(self.path) or os.path.exists(get_txt_path(self.path)):
+            self.path = os.path.join(directory, f"{dataset_name}-{model}-{date}-{i}{extension}")
+            i += 1
+        self._file = open_dataset(self.path, 'w')
+        self._write({"type": "run", "operation": operation, "dataset": dataset_name, "model": model, "date": date})
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record) + "\n")
+        # with gzip, a sync flush: the lines written so far can be read even if the run crashes
+        self._file.flush()
+
+    def write_sample(self, record: dict) -> None:
+        self._write({"type": "sample", **record})
+
+    def write_accuracy(self, accuracy_nat: float, accuracy_syn: float) -> None:
+        self._write({"type": "accuracy", "accuracy_nat": accuracy_nat, "accuracy_syn": accuracy_syn})
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_logs(path: str, type: str = None) -> Iterator[dict]:
+    """Yields the records of a log file (only the ones of the given type, if any), one at a time."""
+    with open_dataset(path, 'r') as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a crashed run can be truncated
+                    continue
+                if type is None or record["type"] == type:
+                    yield record
+        except (EOFError, zlib.error):
+            # a compressed log of a crashed run has no end of stream
+            return
+
+
+def iter_log_entries(path: str, split: str = None, correct: bool = None) -> Iterator[tuple[int, str, dict]]:
+    """
+    Yields (idx, split, log) for the prompts of each sample of a log file, where log has the fields of
+    LogInfo, optionally only the ones of a split ('syn' or 'nat') and with the given correctness.
+    """
+    for record in iter_logs(path, type="sample"):
+        for record_split in ["syn", "nat"]:
+            if split not in [None, record_split]:
+                continue
+            if correct is not None and record[f"correct_{record_split}"] != correct:
+                continue
+            yield record["idx"], record_split, record[record_split]
+
+
+def get_accuracy(path: str) -> dict | None:
+    """The accuracy record of a log file, None if the run did not finish."""
+    for record in iter_logs(path, type="accuracy"):
+        return record
+    return None
+
+
+def to_txt(path: str, out_path: str) -> None:
+    """
+    Writes the log in the .txt format of the previous versions (read by plot.ipynb), the JSON lists of
+    the nat and syn logs, each followed by its accuracy. The log is read twice, not kept in memory.
+    """
+    accuracy = get_accuracy(path)
+    if accuracy is None:
+        raise ValueError(f"{path} is the log of a run that did not finish")
+
+    with open(out_path, 'w') as f:
+        for split, title in [("nat", "Natural"), ("syn", "Synthetic")]:
+            f.write(f"{title} Logs\n[")
+            for i, (_, _, log) in enumerate(iter_log_entries(path, split=split)):
+                f.write((", " if i > 0 else "") + json.dumps(log))
+            f.write("]\n")
+            f.write(f"Accuracy: {accuracy[f'accuracy_{split}']}")
+            f.write("\n")
+
+
+def get_txt_path(path: str) -> str:
+    for extension in [".jsonl.gz", ".jsonl"]:
+        if path.endswith(extension):
+            return path[:-len(extension)] + ".txt"
+    raise ValueError(f"{path} is not a .jsonl(.gz) log")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reads the logs of the experiments.")
+    parser.add_argument('command', choices=['show', 'txt'], help='show: prints the logs of the prompts, one per line; txt: converts the logs to the .txt format read by plot.ipynb')
+    parser.add_argument('paths', nargs='+', type=str, help='Log files, .jsonl or .jsonl.gz')
+    parser.add_argument('--split', choices=['syn', 'nat'], default=None, help='Only show the prompts of this split')
+    correctness = parser.add_mutually_exclusive_group()
+    correctness.add_argument('--correct', action='store_true', help='Only show the prompts answered correctly')
+    correctness.add_argument('--wrong', action='store_true', help='Only show the prompts answered wrongly')
+    parser.add_argument('--fields', type=str, default=None, help='Only show these fields of the logs, comma separated, e.g. label,response')
+    args = parser.parse_args()
+
+    correct = (True if args.correct else False if args.wrong else None)
+    fields = args.fields.split(",") if args.fields is not None else None
+    for path in args.paths:
+        if args.command == "txt":
+            out_path = get_txt_path(path)
+            to_txt(path, out_path)
+            print(f"Saved {out_path}")
+            continue
+
+        try:
+            for idx, split, log in iter_log_entries(path, split=args.split, correct=correct):
+                if fields is not None:
+                    log = {field: log[field] for field in fields}
+                sys.stdout.write(json.dumps({"path": path, "idx": idx, "split": split, **log}) + "\n")
+        except BrokenPipeError:
+            # the output was piped to a command that stopped reading, e.g. head
+            # stdout is redirected so that flushing it at exit does not fail again
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,10 @@ import string
 from pydantic.json import pydantic_encoder
 from abc import ABC, abstractmethod
 
+import numpy as np
+
+from .dataset import write_records
+from .evaluator import apply
 from .my_types import Sample
 class Problem(ABC):
     def __init__(self, name:str):
@@ -14,7 +18,7 @@ class Problem(ABC):
         
 
     @abstractmethod
-    def to_file(self) -> None:
+    def get_path(self, suffix:str="") -> str:
         pass
 
     @abstractmethod        
@@ -36,6 +40,22 @@ class Problem(ABC):
         except Exception as e:
             raise ValueError(e)
 
+    def to_file(self, suffix:str="") -> None:
+        os.makedirs(self.basepath, exist_ok=True)
+        self.dump_data_or_throw(self.get_path(suffix))
+
+    def generate_to_file(self, n_programs=1, suffix:str="") -> str:
+        """
+        Same as generate_data followed by to_file, but the samples are written as they are generated
+        instead of being kept in self.data. The file appears only once it is complete.
+        """
+        os.makedirs(self.basepath, exist_ok=True)
+        path = self.get_path(suffix)
+        tmp_path = os.path.join(os.path.dirname(path), ".tmp-" + os.path.basename(path))
+        write_records(tmp_path, (self._accumulate().model_dump() for _ in range(n_programs)))
+        os.replace(tmp_path, path)
+        return path
+
     
 class StraightLine(Problem):
     def __init__(self, 
@@ -60,12 +80,10 @@ class StraightLine(Problem):
         self.vars = (n_vars if n_vars is not None else self.vars)
         self.instances = (n_instances if n_instances is not None else self.instances)
             
-    def to_file(self, suffix:str="") -> None:
-        os.makedirs(self.basepath, exist_ok=True)
+    def get_path(self, suffix:str="") -> str:
         filename = f"n_ops-{self.n_ops}_n_vars-{self.vars}_n_instances-{self.instances}"
         filename += ".json" if suffix == "" else f"_{suffix}.json"
-        path = self.basepath + filename
-        self.dump_data_or_throw(path)
+        return self.basepath + filename
 
     def _accumulate(self):
         """
@@ -110,7 +128,7 @@ Here's a list of interactions between the agents.
                 if op == '@1-2-give-q@':  # agent1 gives to agent2 quantity q of an object they have
                     # print("Trade")
                     set_agents = set(agents).difference(v1)
-                    v2 = random.choice(list(set_agents))  # chose another agent
+                    v2 = random.choice(sorted(set_agents))  # chose another agent
                     givable = [i for i in range(o) if agents[v1][i]>0] #  select an object v1 can give
                     to_give = random.choice(givable)
                     qt = random.randint(1, agents[v1][to_give])
@@ -193,12 +211,10 @@ class CriticalPath(Problem):
         self.vars = (n_vars if n_vars is not None else self.vars)
         self.critical_path = (len_critical_path if len_critical_path is not None else self.critical_path)
             
-    def to_file(self, suffix:str="") -> None:
-        os.makedirs(self.basepath, exist_ok=True)
+    def get_path(self, suffix:str="") -> str:
         filename = f"n_ops-{self.n_ops}_n_vars-{self.vars}_len_critical_path-{self.critical_path}"
         filename += ".json" if suffix == "" else f"_{suffix}.json"
-        path = self.basepath + filename
-        self.dump_data_or_throw(path)
+        return self.basepath + filename
     
     def _accumulate(self):
         """
@@ -223,7 +239,9 @@ Here's a list of interactions between the agents.
 """
 
         program = ''
-        program = '; '.join([f'a{i}={random.randint(-10, 10)}' for i in range(v)]) + '\n'
+        values = [random.randint(-10, 10) for i in range(v)]
+        program = '; '.join([f'a{i}={values[i]}' for i in range(v)]) + '\n'
+        state = dict(zip(variables, values))  # the value of each variable, updated as the program is generated
         # print(program)
         if n!=c:
             start_inj = random.choice([i for i in range(0, n-c)])
@@ -238,7 +256,7 @@ Here's a list of interactions between the agents.
                 src = random.choice(variables)
                 if '-' in op:  # avoid operation ai -= ai 
                     set_dst = (set(variables[:v_ind]) if isinstance(variables[:v_ind], list) else set([variables[:v_ind]]))
-                    dst = random.choice(list(set_dst - set([src])))
+                    dst = random.choice(sorted(set_dst - set([src])))
                 else:
                     dst = random.choice(variables[:v_ind])
 
@@ -246,7 +264,7 @@ Here's a list of interactions between the agents.
                 src = random.choice(variables)
                 if '-' in op:  # avoid operation ai -= ai 
                     set_dst = (set(variables[:-1]) if isinstance(variables[:-1], list) else set([variables[:-1]]))
-                    dst = random.choice(list(set_dst - set([src])))
+                    dst = random.choice(sorted(set_dst - set([src])))
                 else:
                     dst = random.choice(variables[:-1])
 
@@ -254,7 +272,7 @@ Here's a list of interactions between the agents.
                 src = random.choice(variables[v_ind:])
                 if '-' in op:  # avoid operation ai -= ai 
                     set_dst = (set(variables[v_ind:]) if isinstance(variables[v_ind:], list) else set([variables[v_ind:]]))
-                    dst = random.choice(list(set_dst - set([src])))
+                    dst = random.choice(sorted(set_dst - set([src])))
                 else:
                     dst = random.choice(variables[v_ind:])
                 
@@ -265,14 +283,14 @@ Here's a list of interactions between the agents.
                         # print(src)
                         # print(list(set(variables[v_ind:]) - set([src])))
                         set_dst = (set(variables[v_ind:]) if isinstance(variables[v_ind:], list) else set([variables[v_ind:]]))
-                        dst = random.choice(list(set_dst - set([src])))
+                        dst = random.choice(sorted(set_dst - set([src])))
                     else:
                         dst = random.choice(variables[v_ind:])
                 else:
                     dst = variables[-1]
                     if '-' in op:  # avoid operation ai -= ai 
                         set_src = (set(variables[v_ind:]) if isinstance(variables[v_ind:], list) else set([variables[v_ind:]]))
-                        src = random.choice(list(set_src - set([dst])))
+                        src = random.choice(sorted(set_src - set([dst])))
                     else:
                         src = random.choice(variables[v_ind:])
                         
@@ -287,11 +305,12 @@ Here's a list of interactions between the agents.
             line_2 = (f"{dst} = 0" if '+' in op else f"{dst} *= 2")
                 
             program += line_1 + '\n' + line_2 + '\n'
+            apply(state, src, op.split()[1], dst)
+            apply(state, dst, *(("=", 0) if '+' in op else ("*=", 2)))
             # print(f"{i}: {line}")
             
         # Compute the ground truth
-        exec(program)
-        gt_syn = {variables[-1]: eval(variables[-1])}
+        gt_syn = {variables[-1]: state[variables[-1]]}
         
         sample = Sample(syn=program, nat=prompt, label_syn=gt_syn, label_nat=gt_syn)
         return sample
@@ -311,14 +330,22 @@ class Loops(Problem):
                  n_loops:int, 
                  n_noisy_loops:int,
                  min_loop_length:int=1,
-                 max_loop_length:int=10):
-        
+                 max_loop_length:int=10,
+                 verify:bool=False):
+        """
+        n_loops:int, the number of loops in a program
+        n_noisy_loops:int, the number of loops that do not contribute to the ground truth
+        min_loop_length:int, max_loop_length:int, the range of the number of iterations of each loop
+        verify:bool, also run each program with exec() and check that it returns the ground truth,
+            the program runs up to max_loop_length ** n_loops iterations so use it on small cases only
+        """
         super().__init__(name='Loops')
         assert n_loops > n_noisy_loops >= 0
         self.n_loops = n_loops
         self.n_noisy_loops = n_noisy_loops
         self.min_loop_length = min_loop_length
         self.max_loop_length = max_loop_length
+        self.verify = verify
         self.basepath = "./data/Loops/"
         
     def reset(self, 
@@ -333,12 +360,10 @@ class Loops(Problem):
         self.max_loop_length = (max_loop_length if max_loop_length is not None else self.max_loop_length)
         
         
-    def to_file(self, suffix:str="") -> None:
-        os.makedirs(self.basepath, exist_ok=True)
+    def get_path(self, suffix:str="") -> str:
         filename = f"n_loops-{self.n_loops}_n_noisy_loops-{self.n_noisy_loops}_min_loop_length-{self.min_loop_length}_max_loop-{self.max_loop_length}"
         filename += ".json" if suffix == "" else f"_{suffix}.json"
-        path = self.basepath + filename
-        self.dump_data_or_throw(path)
+        return self.basepath + filename
 
     def _accumulate(self):
         c = self.n_loops; cn = self.n_noisy_loops
@@ -354,6 +379,9 @@ class Loops(Problem):
         
         program = '; '.join([f"n_{i}=0" for i in set_c]) + '\n'
         n_tabs = 0
+        # n_{idx} is incremented k times for each iteration of the necessary loops that enclose it
+        multiplier = 1
+        counters = {}
         for idx, is_necessary in loops.items():
             tabs_decl = '\t'*(n_tabs)
             tabs_body = '\t'*(n_tabs+1)
@@ -361,9 +389,11 @@ class Loops(Problem):
             k = random.randint(self.min_loop_length, self.max_loop_length)
             program += tabs_decl + f"for _ in range({k}):\n"
             program += tabs_body + f"n_{idx} += 1\n"
+            counters[idx] = k * multiplier
             
             if is_necessary:
                 n_tabs += 1
+                multiplier *= k
                 prompt += f"There are {k} {nat_objects[ptr_nat]} in {nat_objects[ptr_nat-1]}.\n"
                 ptr_nat += 1
             else:
@@ -371,8 +401,11 @@ class Loops(Problem):
                 ptr_noisy_nat += 1
         
         # Generate the ground truth label
-        exec(program)
-        gt = eval(f"n_{set_c[-1]}")
+        gt = counters[set_c[-1]]
+        if self.verify:
+            namespace = {}
+            exec(program, namespace)
+            assert all(namespace[f"n_{i}"] == counters[i] for i in set_c), program
         gt_syn = {f"n_{set_c[-1]}": gt}
         gt_nat = {f"obj-{set_c[-1]} in obj-gen": gt}
         
@@ -406,12 +439,10 @@ class Sort(Problem):
         self.n_ops = (n_vars if n_vars is not None else self.n_vars)
         self.ascending = (ascending if ascending is not None else self.ascending)
             
-    def to_file(self, suffix:str="") -> None:
-        os.makedirs(self.basepath, exist_ok=True)
+    def get_path(self, suffix:str="") -> str:
         filename = f"n_vars-{self.n_vars}_ascending-{self.ascending}"
         filename += ".json" if suffix == "" else f"_{suffix}.json"
-        path = self.basepath + filename
-        self.dump_data_or_throw(path)
+        return self.basepath + filename
         
     def _accumulate(self):
         """
@@ -438,5 +469,47 @@ Simulate the following algorithm with the list of numbers as input:\n
                   
         sample = Sample(syn=program, nat=prompt, label_syn=gt_syn, label_nat=gt_nat)
         return sample
-        
-        
\ No newline at end of file
+
+    def generate_data_batched(self, n_programs=1, seed:int=None, chunk_size:int=None) -> None:
+        """
+        Same as generate_data, but the weights, the positions k and the sorted orders of a chunk of
+        samples are drawn as NumPy arrays, and the strings are formatted at the end.
+        The samples have the same distribution as the ones of _accumulate (not the same values).
+        seed:int, the seed of the NumPy generator, for reproducible data
+        chunk_size:int, the number of samples drawn at once, by default ~1M random keys per chunk
+        """
+        n = self.n_vars
+        # separate streams for the keys and for k, so the samples do not depend on chunk_size
+        keys_rng, k_rng = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(2)]
+        chunk_size = (chunk_size if chunk_size is not None else max(1, (1 << 20) // (10*n)))
+        names = [f"obj-{i}" for i in range(n)]
+        keys_prefix = [f"'{name}': " for name in names]
+        numbers = [str(v) for v in range(10*n)]
+        prompt_prefix = f"One has the following {n} objects: {names}.\n\nThis is the weight of each object in Kg: {{"
+        program_suffix = f"""]\n
+Simulate the following algorithm with the list of numbers as input:\n
+{self.algorithm.format(condition='<' if self.ascending else '>')}
+"""
+        for start in range(0, n_programs, chunk_size):
+            size = min(chunk_size, n_programs - start)
+            rows = np.arange(size)
+            # as random.sample: n distinct values in range(10*n), the ones with the n smallest random keys, ordered by key
+            keys = keys_rng.random((size, 10*n))
+            weights = np.argpartition(keys, n-1, axis=1)[:, :n]
+            weights = np.take_along_axis(weights, np.argsort(np.take_along_axis(keys, weights, axis=1), axis=1), axis=1)
+            ks = k_rng.integers(0, n, size=size)
+            # index of the object in position k of the sorted list
+            indices = np.argsort(weights, axis=1)[rows, (ks if self.ascending else n-1-ks)]
+            labels = weights[rows, indices]
+
+            for w, k, idx, label in zip(weights.tolist(), ks.tolist(), indices.tolist(), labels.tolist()):
+                values = list(map(numbers.__getitem__, w))
+                prompt = prompt_prefix + ", ".join(map(str.__add__, keys_prefix, values)) + "}.\n\n"
+                program = "Here's a list of numbers. x = [" + ", ".join(values) + program_suffix
+                gt_syn = {'position': k,
+                          'label': label,
+                          'ascending': self.ascending}
+                gt_nat = {'position': k+1,
+                          'label': names[idx],
+                          'ascending': self.ascending}
+                self.data.append(Sample(syn=program, nat=prompt, label_syn=gt_syn, label_nat=gt_nat))
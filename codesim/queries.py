@@ -0,0 +1,103 @@
+"""
+Prompts of the experiments rendered once per dataset, <dataset file>.prompts.jsonl.gz next to the dataset
+(e.g. x.json.prompts.jsonl.gz, so that x.json and its converted copy x.jsonl.gz have their own file).
+
+format_query picks some of the asked variables at random, so the prompts of a dataset are rendered
+once with a recorded seed and then read by every run, which sends the same bytes each time (and
+finds them in the response cache). The first line describes how the prompts were rendered,
+{"type": "header", "operation", "dataset", "dataset_hash", "template_hash", "code_hash", "seed"},
+then each line has the prompts of a sample, {"idx", "syn": {"prompt", "answer"}, "nat": {...}}.
+A file whose header does not match the dataset, the templates, the code rendering them or the seed
+is rendered again.
+Write them ahead of time with `python3 -m codesim.experiment -o <operation> --materialize-only`.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+from typing import Iterable, Iterator
+
+from .dataset import open_dataset
+
+PROMPTS_EXTENSION = ".prompts.jsonl.gz"
+
+
+def get_prompts_path(dataset_path: str) -> str:
+    return dataset_path + PROMPTS_EXTENSION
+
+
+def is_prompts_file(path: str) -> bool:
+    return path.endswith(PROMPTS_EXTENSION)
+
+
+def get_file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_template_hash(templates: type, object_map: dict) -> str:
+    """
+    templates:type, the class of prompt.py used by the operation
+    object_map:dict, the objects substituted in the nat prompts
+    """
+    payload = json.dumps({
+        "templates": {name: value for name, value in vars(templates).items() if not name.startswith("__")},
+        "objects": {str(i): name for i, name in object_map.items()}
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_source_hash(functions: list) -> str:
+    """The hash of the source of the functions that render the prompts, so that a change to them renders the prompts again."""
+    source = "\n".join(inspect.getsource(function) for function in functions)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def read_header(path: str) -> dict | None:
+    """The header of a prompts file, None if the file does not exist or cannot be read."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open_dataset(path, 'r') as f:
+            header = json.loads(f.readline())
+    except (OSError, EOFError, json.JSONDecodeError):
+        return None
+    return header if header.get("type") == "header" else None
+
+
+def is_up_to_date(path: str, header: dict) -> bool:
+    """True if the prompts file was rendered as described by header."""
+    current = read_header(path)
+    if current is None:
+        return False
+    return all(current.get(key) == value for key, value in header.items())
+
+
+def write_queries(path: str, header: dict, queries: Iterable[tuple[dict, dict]]) -> int:
+    """
+    Writes the (syn, nat) prompts of each sample, as {"prompt", "answer"}, one at a time after header,
+    and returns the number of samples.
+    """
+    num_samples = 0
+    # written aside and renamed, a run never reads a half-written file
+    tmp_path = os.path.join(os.path.dirname(path), ".tmp-" + os.path.basename(path))
+    with open_dataset(tmp_path, 'w') as f:
+        f.write(json.dumps({"type": "header", **header}) + "\n")
+        for query_syn, query_nat in queries:
+            f.write(json.dumps({"idx": num_samples, "syn": query_syn, "nat": query_nat}) + "\n")
+            num_samples += 1
+    os.replace(tmp_path, path)
+    return num_samples
+
+
+def iter_queries(path: str) -> Iterator[tuple[dict, dict]]:
+    """Yields the (syn, nat) prompts of each sample of a prompts file, in the order of the dataset."""
+    with open_dataset(path, 'r') as f:
+        f.readline()
+        for line in f:
+            record = json.loads(line)
+            yield record["syn"], record["nat"]
@@ -0,0 +1,89 @@
+"""
+Client-side rate limiting of the requests sent to an endpoint.
+
+Each model can set "rpm" (requests per minute) and "tpm" (tokens per minute) in the `config` dict.
+Calls are paced to stay within these budgets, instead of hitting the endpoint until it answers 429;
+when it does, the Retry-After it sends pauses all the calls to that model.
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        """
+        rate_per_minute:float, the number of tokens added to the bucket every minute
+        capacity:float, the maximum number of tokens in the bucket (the burst size), by default
+            the tokens of a single request, so that calls are evenly spaced
+        """
+        self.rate = rate_per_minute / 60.
+        self.capacity = capacity
+        # full when the first request comes, only the following ones are paced
+        self._tokens = None
+        self._last = None
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Takes amount tokens from the bucket and returns the seconds to wait before they are available."""
+        capacity = self.capacity if self.capacity is not None else amount
+        if self._tokens is None:
+            self._tokens, self._last = capacity, now
+        self._tokens = min(capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # the bucket can go below zero: the next requests wait for the tokens this one borrowed
+        self._tokens -= amount
+        return max(0., -self._tokens / self.rate)
+
+    def delay(self, seconds: float, now: float) -> None:
+        """Makes the next reservations wait at least the given seconds, still spaced by the rate."""
+        self.reserve(0., now)
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class RateLimiter:
+    def __init__(self, rpm: float = None, tpm: float = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self._paused_until = 0.
+        self._lock = threading.Lock()
+
+    def acquire(self, num_tokens: int = 0) -> None:
+        """Blocks until a request with num_tokens tokens fits in the budgets."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(num_tokens, now))
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Stops all the requests for the given seconds, e.g., after a 429 with Retry-After."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # otherwise all the calls waiting for the pause would be sent at once when it ends
+            for bucket in [self.requests, self.tokens]:
+                if bucket is not None:
+                    bucket.delay(seconds, now)
+
+
+def get_retry_after(exception: Exception) -> float | None:
+    """Returns the seconds to wait suggested by the Retry-After headers of a failed request, if any."""
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000.
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an HTTP date, which we do not handle
+        pass
+    return None
@@ -0,0 +1,157 @@
+"""
+Append-only store of the accuracies of each (operation, model, dataset), in a SQLite file.
+
+Each finished dataset adds a row, instead of rewriting results/<operation>/<model>.csv, so runs of
+different models (or of the same one) can share the results directory, and a crash does not leave
+a half-written file. The CSV files that plot.ipynb reads are regenerated from the store with
+`python3 -m codesim.results export`; the rows of the CSV files written before the store existed
+are imported the first time their operation and model are used (or all at once with `import`).
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+import threading
+
+from .my_types import OperationType
+
+CSV_COLUMNS = ["accuracy_nat", "accuracy_syn", "date", "dataset"]
+
+
+class ResultsStore:
+    def __init__(self, path: str = "results/results.sqlite", csv_dir: str = "results"):
+        """
+        path:str, the SQLite file where the results are stored
+        csv_dir:str, the directory with the CSV files, results/<operation>/<model>.csv
+        """
+        self.path = path
+        self.csv_dir = csv_dir
+        self._lock = threading.Lock()
+        self._imported = set()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # other processes can write the same file, they wait for each other's transactions
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operation TEXT,
+            model TEXT,
+            dataset TEXT,
+            accuracy_nat REAL,
+            accuracy_syn REAL,
+            date TEXT
+        )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_dataset ON results (operation, model, dataset)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS imported_csv (operation TEXT, model TEXT, PRIMARY KEY (operation, model))")
+
+    def get_csv_path(self, operation: str, model: str) -> str:
+        return os.path.join(self.csv_dir, operation, f"{model}.csv")
+
+    def _import_csv(self, operation: str, model: str) -> None:
+        """Adds the rows of the CSV file of operation and model, once, if the file exists."""
+        if (operation, model) in self._imported:
+            return
+
+        path = self.get_csv_path(operation, model)
+        with self._lock:
+            # the check and the import are a single transaction, another process cannot import the file as well
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self._conn.execute("SELECT 1 FROM imported_csv WHERE operation = ? AND model = ?",
+                                          (operation, model)).fetchone()
+                if done is None and os.path.exists(path):
+                    with open(path, newline='') as f:
+                        rows = [(operation, model, row["dataset"], float(row["accuracy_nat"]), float(row["accuracy_syn"]), row["date"])
+                                for row in csv.DictReader(f)]
+                    self._conn.executemany("""INSERT INTO results (operation, model, dataset, accuracy_nat, accuracy_syn, date)
+                        VALUES (?, ?, ?, ?, ?, ?)""", rows)
+                    print(f"Imported {len(rows)} results from {path}")
+                self._conn.execute("INSERT OR IGNORE INTO imported_csv VALUES (?, ?)", (operation, model))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._imported.add((operation, model))
+
+    def add(self, operation: str, model: str, dataset: str, accuracy_nat: float, accuracy_syn: float, date: str) -> None:
+        self._import_csv(operation, model)
+        with self._lock:
+            self._conn.execute("""INSERT INTO results (operation, model, dataset, accuracy_nat, accuracy_syn, date)
+                VALUES (?, ?, ?, ?, ?, ?)""", (operation, model, dataset, accuracy_nat, accuracy_syn, date))
+
+    def is_done(self, operation: str, model: str, dataset: str) -> bool:
+        """True if there are results of the model on the dataset."""
+        self._import_csv(operation, model)
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM results WHERE operation = ? AND model = ? AND dataset = ? LIMIT 1",
+                                     (operation, model, dataset)).fetchone()
+        return row is not None
+
+    def get_rows(self, operation: str, model: str) -> list[dict]:
+        """The results of the model on the operation, ordered by dataset and date as in the CSV files."""
+        self._import_csv(operation, model)
+        with self._lock:
+            rows = self._conn.execute("""SELECT accuracy_nat, accuracy_syn, date, dataset FROM results
+                WHERE operation = ? AND model = ? ORDER BY dataset, date, id""", (operation, model)).fetchall()
+        return [dict(zip(CSV_COLUMNS, row)) for row in rows]
+
+    def import_all_csv(self) -> None:
+        """Imports the CSV files of all the operations, results/<operation>/<model>.csv."""
+        for operation in OperationType:
+            operation_dir = os.path.join(self.csv_dir, operation.value)
+            if os.path.isdir(operation_dir):
+                for filename in sorted(os.listdir(operation_dir)):
+                    if filename.endswith(".csv") and not filename.startswith("."):
+                        self._import_csv(operation.value, filename[:-len(".csv")])
+
+    def list_runs(self) -> list[tuple[str, str]]:
+        """The (operation, model) pairs with results in the store."""
+        with self._lock:
+            return self._conn.execute("SELECT DISTINCT operation, model FROM results ORDER BY operation, model").fetchall()
+
+    def export_csv(self, operation: str, model: str) -> str:
+        """Writes results/<operation>/<model>.csv, in the layout read by plot.ipynb, and returns its path."""
+        rows = self.get_rows(operation, model)
+        path = self.get_csv_path(operation, model)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, a reader never sees a half-written file
+        tmp_path = os.path.join(os.path.dirname(path), f".{model}.csv.tmp")
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS, lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, path)
+        return path
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Imports the CSV files of the results in the store, or exports the store to the CSV files read by plot.ipynb.")
+    parser.add_argument('command', choices=['import', 'export'], help='import: adds the rows of the CSV files not imported yet; export: writes results/<operation>/<model>.csv for each operation and model')
+    parser.add_argument('--results-path', default='results/results.sqlite', type=str, help='Path of the SQLite file with the results')
+    parser.add_argument('-o', '--operation', type=str, default=None, help='Only export this operation')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Only export this model')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.results_path)
+    if args.command == "import":
+        store.import_all_csv()
+        store.close()
+        return
+
+    for operation, model in store.list_runs():
+        if args.operation not in [None, operation] or args.model not in [None, model]:
+            continue
+        print(f"Saved {store.export_csv(operation, model)}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,14 @@ This file's responsibility is to restart the experiments when they are not runni
 """
 
 import argparse
-import os
-import datetime
+import traceback
 from time import sleep
-import pandas as pd
 
-from .my_types import Sample, OperationType
-from .experiment import get_dataset_path
+from .my_types import OperationType
+from .experiment import get_dataset_path, list_datasets, init_cache, init_results, get_results_store, get_tracker, close_tracker, run_dataset
+from .cache import CACHE_MODES
+from .dataset import get_dataset_name
+from .logs import LOG_FORMATS
 
 def main():
     parser = argparse.ArgumentParser(description="Start experiments for the CodeSimulation project.")
@@ -17,26 +18,42 @@ def main():
                         help='Type of operation to perform')
     parser.add_argument('-m', '--model', type=str, help='Model to use for the experiment')
     parser.add_argument('--wandb', action='store_true', help='Use wandb for logging, if not, use default txt file')
+    parser.add_argument('--concurrency', default=1, type=int, help='Number of samples queried in parallel')
+    parser.add_argument('--batch-size', default=1, type=int, help='Number of prompts generated in a single batch, for local models')
+    parser.add_argument('--cache-mode', default='off', choices=CACHE_MODES, help='Whether to read and/or write model responses from the cache')
+    parser.add_argument('--cache-path', default='.cache/responses.sqlite', type=str, help='Path of the SQLite file with the cached responses')
+    parser.add_argument('--cache-max-entries', default=1_000_000, type=int, help='Maximum number of cached responses, the least recently used are evicted')
+    parser.add_argument('--results-path', default='results/results.sqlite', type=str, help='Path of the SQLite file where the results are stored')
+    parser.add_argument('--log-format', default='jsonl', choices=LOG_FORMATS, help='Format of the logs in logs/<operation>, txt is the format of the previous versions, converted from jsonl at the end of each dataset')
+    parser.add_argument('--prompt-seed', default=0, type=int, help='Seed of the prompts rendered in <dataset>.prompts.jsonl.gz, the first time a dataset is run or when the templates change')
+    parser.add_argument('--render-prompts', action='store_true', help='Render the prompts at each run, as in the previous versions, instead of reading them from <dataset>.prompts.jsonl.gz')
+    parser.add_argument('--retries', default=1, type=int, help='Number of times a failed dataset is run again before going to the next one')
 
     
     args = parser.parse_args()
+    init_cache(args.cache_mode, args.cache_path, args.cache_max_entries)
+    init_results(args.results_path)
     op_type: OperationType = OperationType(args.operation)
-    dataset_base = get_dataset_path(op_type)
-    dataset_list = []
-    for dataset in os.listdir(dataset_base):
-        dataset_list.append(os.path.join(dataset_base, dataset))
-    dataset_list = sorted(dataset_list)
-    
+    dataset_list = list_datasets(get_dataset_path(op_type))
+
     for dataset in dataset_list:
-        dataset_name = os.path.basename(dataset)
+        dataset_name = get_dataset_name(dataset)
         if check_results(args, dataset_name):
             print(f"Skipping {dataset_name}...")
             continue
 
         print(f"Running {dataset_name}...")
         i = 0
-        while i < 1:
-            os.system(f"python3 -m codesim.experiment -o {args.operation} -m {args.model} --dataset_path {dataset} {'--wandb' if args.wandb else ''}")
+        while i <= args.retries:
+            # Each dataset runs in this process: a failure is isolated to the dataset and the
+            # answers of the samples already queried are kept in the journal for the next attempt.
+            try:
+                run_dataset(op_type, args.model, dataset, use_wandb=args.wandb, concurrency=args.concurrency, batch_size=args.batch_size, log_format=args.log_format,
+                            prompt_seed=None if args.render_prompts else args.prompt_seed)
+            except Exception:
+                traceback.print_exc()
+                if args.wandb:
+                    get_tracker().finish_run(args.operation, args.model, exit_code=1)
             if check_results(args, dataset_name):
                 break
             # allow to kill the main program
@@ -46,20 +63,11 @@ def main():
         else:
             print(f"Failed to run {dataset_name}... Going next")
         print(f"Finished {dataset_name}...")
+    print(f"Saved {get_results_store().export_csv(args.operation, args.model)}")
+    close_tracker()
 
 def check_results(args, dataset_name):
-    basedir = os.path.join("results", args.operation)
-    os.makedirs(basedir, exist_ok=True)
-    
-    filename = f"{basedir}/{args.model}.csv"
-    if os.path.exists(filename):
-        df = pd.read_csv(filename)
-        
-        # check if dataset_name is already in the dataframe
-        if dataset_name in df["dataset"].values:
-            return True
-
-    return False
+    return get_results_store().is_done(args.operation, args.model, dataset_name)
 
 if __name__ == "__main__":
     # test if works
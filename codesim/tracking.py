@@ -0,0 +1,96 @@
+"""
+Tracking of the experiments on wandb, in a background thread.
+
+The experiment sends the records of the answered samples and the accuracies through a queue; the
+worker adds them to the tables of the run, and logs the artifacts and finishes the run while the
+experiment goes on with the next dataset. The runs are handled one at a time, in the order they
+are started. Set WANDB_MODE=offline to try it without uploading.
+"""
+
+import atexit
+import queue
+import threading
+import traceback
+
+TABLE_COLUMNS = ["prompt", "label", "response", "full_response", "is_correct"]
+
+
+class WandbTracker:
+    def __init__(self, project: str = "codesim"):
+        self.project = project
+        self.errors = 0
+        self._queue = queue.Queue()
+        # daemon, so a crash of the experiment does not hang on the worker, close() is called at exit instead
+        self._thread = threading.Thread(target=self._work, name="wandb-tracker", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def start_run(self, config: dict) -> None:
+        self._queue.put(("start", config))
+
+    def log_sample(self, record: dict) -> None:
+        """record has the LogInfo of the syn and nat prompts of a sample, as in experiment.experiment."""
+        self._queue.put(("sample", record))
+
+    def log_metrics(self, metrics: dict) -> None:
+        self._queue.put(("metrics", metrics))
+
+    def finish_run(self, operation: str, model: str, exit_code: int = 0) -> None:
+        """Logs the tables of the current run as artifacts (if it succeeded) and finishes it."""
+        self._queue.put(("finish", (operation, model, exit_code)))
+
+    def flush(self) -> None:
+        """Waits until everything sent so far is logged."""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _work(self) -> None:
+        # imported here as it takes a while and it is not needed on the request path
+        import wandb
+
+        run = None
+        tables = None
+        while True:
+            message = self._queue.get()
+            try:
+                if message is None:
+                    if run is not None:
+                        run.finish(exit_code=1)
+                    return
+
+                kind, payload = message
+                if kind == "start":
+                    if run is not None:
+                        run.finish(exit_code=1)
+                    # a bool, as in the pinned wandb 0.18 (newer versions read True as "finish_previous")
+                    run = wandb.init(project=self.project, config=payload, reinit=True)
+                    tables = {split: wandb.Table(columns=TABLE_COLUMNS) for split in ["nat", "syn"]}
+                elif run is None:
+                    # the run failed to start, its messages are dropped
+                    continue
+                elif kind == "sample":
+                    for split, table in tables.items():
+                        table.add_data(*[payload[split][column] for column in TABLE_COLUMNS])
+                elif kind == "metrics":
+                    run.log(payload)
+                elif kind == "finish":
+                    operation, model, exit_code = payload
+                    if exit_code == 0:
+                        for split, table in tables.items():
+                            artifact = wandb.Artifact(f"{split}-{operation}-{model}", type="dataset")
+                            artifact.add(table, f"results-{split}")
+                            run.log_artifact(artifact)
+                    run.finish(exit_code=exit_code)
+                    run, tables = None, None
+            except Exception:
+                # tracking must not stop the experiments
+                self.errors += 1
+                traceback.print_exc()
+                if message is not None and message[0] in ["start", "finish"]:
+                    run, tables = None, None
+            finally:
+                self._queue.task_done()
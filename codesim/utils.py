@@ -1,19 +1,25 @@
 import json
-import openai
-import tiktoken
-import requests
 import os
+import threading
+import time
 from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
 import backoff
-import transformers
 # from groq import Groq
 from functools import partial
-import numpy as np
-from openai import AzureOpenAI  
+from .ratelimit import RateLimiter, get_retry_after
 
+# The backends import their heavy dependencies (openai, tiktoken, transformers) when first used,
+# so that importing this module does not slow down every run.
 
-__encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
+__encoder = None
+
+def get_encoder():
+    """Returns the tiktoken encoder used to count tokens, created on first use."""
+    global __encoder
+    if __encoder is None:
+        import tiktoken
+        __encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return __encoder
 
 # We assume that on a single process at most a single model is loaded.
 local_model = None
@@ -24,6 +30,18 @@ local_tokenizer = None
 
 total_cost = 0
 
+g_config = None
+
+# API clients, one per configured model, shared by all the queries (and threads) of the process
+# so that connections are kept alive instead of being opened for every prompt.
+g_clients = dict()
+g_clients_stats = dict()
+g_clients_lock = threading.Lock()
+g_pool_size = 10
+
+# Rate limiters of the models with "rpm" and/or "tpm" in their config, None for the others.
+g_rate_limiters = dict()
+
 def get_total_cost():
     return total_cost
 
@@ -32,7 +50,7 @@ class OverloadedException(Exception):
 def _query_model_handle_errors(prompts: list[str],
                                 config_file: str,
                                 model_name: str,
-                                encoder: tiktoken.Encoding = None,
+                                encoder: "tiktoken.Encoding" = None,
                                 max_tokens: int = 15000,
                                 tag: str = "#GPT#",
                                 **kwargs
@@ -62,6 +80,7 @@ def _query_model_handle_errors(prompts: list[str],
 
         name = config_json[model_name]["name"]
         if local_model is None:
+            from transformers import AutoModelForCausalLM, AutoTokenizer
             local_model = AutoModelForCausalLM.from_pretrained(name, device_map="auto", cache_dir=".cache/huggingface/hub")
             local_tokenizer = AutoTokenizer.from_pretrained(name, cache_dir=".cache/huggingface/hub")
             local_model.eval()
@@ -85,20 +104,110 @@ def _query_model_handle_errors(prompts: list[str],
 
     return description
 
+def load_config():
+    """Returns the `config` dict from codesim/config.py, or an empty dict if there is none."""
+    global g_config
+    if g_config is None:
+        try:
+            from . import config
+            g_config = config.config
+        except ImportError:
+            g_config = {}
+    return g_config
+
+def set_pool_size(pool_size: int):
+    """Sets the maximum number of connections kept by each client created from now on."""
+    global g_pool_size
+    g_pool_size = max(1, pool_size)
+
+def get_client(client_class, jdata: dict, **kwargs):
+    """
+    Returns the client of the model configured by jdata, building it on first use.
+    client_class is an openai client class (e.g., openai.OpenAI or openai.AzureOpenAI),
+    kwargs are the arguments to construct it.
+    """
+    import httpx
+    import openai
+    if "rpm" in jdata or "tpm" in jdata:
+        # retries must go through the rate limiter (see queryLLM), not through the client
+        kwargs["max_retries"] = 0
+    client_id = (client_class.__name__, json.dumps(jdata, sort_keys=True), json.dumps(kwargs, sort_keys=True))
+    with g_clients_lock:
+        if client_id not in g_clients:
+            stats = {"model": jdata.get("name"), "requests": 0, "max_connections": g_pool_size}
+
+            def count_request(request):
+                stats["requests"] += 1
+
+            http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=g_pool_size, max_keepalive_connections=g_pool_size),
+                event_hooks={"request": [count_request]}
+            )
+            g_clients[client_id] = client_class(http_client=http_client, **kwargs)
+            g_clients_stats[client_id] = stats
+        return g_clients[client_id]
+
+def get_client_stats() -> list[dict]:
+    """Returns, for each client, the number of requests sent and of connections currently open."""
+    stats = []
+    with g_clients_lock:
+        for client_id, client in g_clients.items():
+            pool = getattr(getattr(client._client, "_transport", None), "_pool", None)
+            open_connections = len(pool.connections) if pool is not None else None
+            stats.append({**g_clients_stats[client_id], "open_connections": open_connections})
+    return stats
+
+def get_rate_limiter(model: str) -> RateLimiter | None:
+    with g_clients_lock:
+        if model not in g_rate_limiters:
+            jdata = load_config().get(model, {})
+            has_limits = "rpm" in jdata or "tpm" in jdata
+            g_rate_limiters[model] = RateLimiter(rpm=jdata.get("rpm"), tpm=jdata.get("tpm")) if has_limits else None
+        return g_rate_limiters[model]
+
+def estimate_tokens(prompt, jdata: dict) -> int:
+    """Tokens counted against the tpm budget: the prompt plus the expected completion length."""
+    text = prompt if isinstance(prompt, str) else json.dumps(prompt)
+    return len(get_encoder().encode(text)) + jdata.get("expected_completion_tokens", 0)
+
+def queryLLM_batch(prompts: list[str], model, **kwargs) -> list[str]:
+    """
+    Queries the model with a list of prompts, in a single batch if the backend supports it
+    (see f_query_batched), one prompt at a time otherwise.
+    """
+    if f_query[model] not in f_query_batched:
+        return [queryLLM(prompt, model, **kwargs) for prompt in prompts]
+
+    jdata = load_config()
+    try:
+        return f_query[model](prompts, jdata.get(model, {}), **kwargs)
+    except Exception as inst:
+        print(type(inst))
+        print(f"[error] Querying model {model} with a batch of {len(prompts)} prompts has failed. Error: {inst}")
+        raise inst
+
 def queryLLM(prompt, model, **kwargs):
-    from . import config
     global f_query
 
-    jdata = config.config
+    jdata = load_config()
     response = None
+    rate_limiter = get_rate_limiter(model)
     try:
         # print(f"Querying {model}. Available models: {[m for m in f_query.keys()]}.")
         # print()
-        response = f_query[model](prompt, jdata[model], **kwargs)
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimate_tokens(prompt, jdata[model]) if rate_limiter.tokens is not None else 0)
+        if f_query[model] in f_query_batched:
+            response = f_query[model]([prompt], jdata.get(model, {}), **kwargs)[0]
+        else:
+            response = f_query[model](prompt, jdata.get(model, {}), **kwargs)
     except Exception as inst:
         # print exception info
         print(type(inst))    # the exception instance
         print(f"[error] Querying model {model} has failed. Error: {inst}")
+        retry_after = get_retry_after(inst)
+        if rate_limiter is not None and retry_after is not None:
+            rate_limiter.pause(retry_after)
         raise inst
 
     return response
@@ -134,6 +243,7 @@ def queryllama(prompt, jdata, max_new_tokens=500, device="cpu"):
             raise ValueError(f"Model {model_name} not supported")
         
     if local_model is None:
+        import transformers
         local_model = transformers.pipeline(
             "text-generation",
             model=llama_path,
@@ -196,6 +306,7 @@ def queryllamachat(messages, jdata, max_new_tokens=500, device="cpu"):
             raise ValueError(f"Model {model_name} not supported")
         
     if local_model is None:
+        import transformers
         local_model = transformers.pipeline(
             "text-generation",
             model=llama_path,
@@ -237,8 +348,15 @@ def querygemma(prompts: list[str], jdata, max_new_tokens=500, device="cuda:3"):
 
     model_name = os.path.join(jdata["organization"], jdata['name'])
     cache_dir = "./.cache/huggingface/hub"
+    max_new_tokens = jdata.get("max_new_tokens", max_new_tokens)
+    device = jdata.get("device", device)
     if local_model is None:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
         local_tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
+        # decoder-only models must be padded on the left to generate a batch
+        local_tokenizer.padding_side = "left"
+        if local_tokenizer.pad_token is None:
+            local_tokenizer.pad_token = local_tokenizer.eos_token
         local_model = AutoModelForCausalLM.from_pretrained(
             model_name,
             device_map=device,
@@ -253,13 +371,13 @@ def querygemma(prompts: list[str], jdata, max_new_tokens=500, device="cuda:3"):
         role_dict = [{"role": "user", "content": p}]
         chats[i] = tokenizer.apply_chat_template(role_dict, tokenize=False, add_generation_prompt=True)
     model_inputs = tokenizer(chats, add_special_tokens=False, padding=True, return_tensors="pt").to(device)
-    out = llm.generate(**model_inputs, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.eos_token_id, temperature=0)
+    out = llm.generate(**model_inputs, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id, do_sample=False)
 
+    # the generated tokens follow the (padded) prompt tokens
+    prompt_length = model_inputs["input_ids"].shape[1]
     output = ["" for _ in range(len(prompts))]
     for i, o in enumerate(out):
-        completion = tokenizer.decode(o)
-        prefix = chats[i]
-        output[i] = completion[len(prefix):]
+        output[i] = tokenizer.decode(o[prompt_length:], skip_special_tokens=True)
 
     return output
 
@@ -267,13 +385,14 @@ def querygpt(prompt, jdata):
     """
     https://platform.openai.com/docs/guides/gpt/chat-completions-api
     """
+    import openai
 
     model_name = jdata['name']
     
     if "api_base" in jdata:
-        client = openai.Client(api_key=jdata['key'], base_url=jdata['api_base'])
+        client = get_client(openai.Client, jdata, api_key=jdata['key'], base_url=jdata['api_base'])
     else:
-        client = openai.Client(api_key=jdata['key'])
+        client = get_client(openai.Client, jdata, api_key=jdata['key'])
 
     completion = client.chat.completions.create(
                                                 model = model_name,
@@ -285,11 +404,12 @@ def querygpt(prompt, jdata):
     return completion.choices[0].message.content
 
 def queryllamasambanova(prompt, jdata):
+    import openai
     
     model_name = jdata['name']
     api_key = jdata['key']
 
-    client = openai.OpenAI(
+    client = get_client(openai.OpenAI, jdata,
         api_key=api_key,
         base_url="https://api.sambanova.ai/v1",
     )
@@ -316,7 +436,6 @@ def track_costs(model_name: str, completion, input_cost: float, output_cost: flo
     global total_cost
     try:
         example_cost = CostClass(prompt_tokens=0, completion_tokens=0, cumulative_tokens=0, cumulative_cost=0)
-        global __encoder
         update_cost_path = f"./costs/costs-{model_name}.txt"
         os.makedirs(os.path.dirname(update_cost_path), exist_ok=True)
         if not os.path.exists(update_cost_path):
@@ -346,6 +465,7 @@ def queryinstruct(prompt, jdata):
     """
     https://platform.openai.com/docs/guides/gpt/chat-completions-api
     """
+    import openai
     openai.organization = jdata['organization']
     openai.api_key = jdata['key']
     model_name = jdata['name']
@@ -365,6 +485,7 @@ def queryinstruct(prompt, jdata):
     return completion
 
 def querygptazurechat(prompt, jdata):
+    import openai
     openai.api_type = jdata['api_type']
     openai.base_url = jdata['api_base']
     openai.api_version = jdata['api_version']
@@ -402,7 +523,9 @@ def querygptazure(prompt, jdata, temperature=0., n=1, stop=None):
     """
     GPT-4 Azure endpoint required (stored locally)
     """
-    client = AzureOpenAI(  
+    import openai
+    from openai import AzureOpenAI
+    client = get_client(AzureOpenAI, jdata,
         azure_endpoint=jdata['api_base'],  
         api_key=jdata['key'],  
         api_version="2024-05-01-preview",
@@ -449,6 +572,14 @@ def querygptazure(prompt, jdata, temperature=0., n=1, stop=None):
     else:
         return outputs
 
+def queryfake(prompt, jdata):
+    """
+    Local stand-in for an API model: waits `latency` seconds (default 1) and
+    answers with a number derived from the prompt, so that runs are reproducible.
+    """
+    time.sleep(jdata.get("latency", 1.))
+    return f"<answer>{len(prompt) % 10}</answer>"
+
 f_query = {
     'gpt-3.5':querygpt, 
     'gpt-4o-mini': querygpt,
@@ -464,6 +595,11 @@ f_query = {
     'llama-3-8B-chat':queryllamachat,
     'gemma-2B':querygemma,
     'gemma-7B':querygemma,
+    'hf-local':querygemma,  # any local HuggingFace chat model, "organization"/"name" in the config
     'gpt-3.5-instruct': queryinstruct,
-    'sambanova-llama': queryllamasambanova
-}
\ No newline at end of file
+    'sambanova-llama': queryllamasambanova,
+    'fake': queryfake
+}
+
+# Backends that take a list of prompts and generate them in a single batch.
+f_query_batched = {querygemma}
@@ -3,5 +3,5 @@ for operation in 'straight-line' 'critical-path' 'parallel-paths' 'nested-loop'
 do
     python3 -m codesim.runner \
         --model gpt-4-azure  \
-        --operation $operation --wandb
+        --operation $operation --wandb --cache-mode readwrite
 done
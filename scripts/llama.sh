@@ -3,8 +3,8 @@ for model in 'kim-schuster' # 'straight-line' 'critical-path' 'parallel-paths' '
 do
     python3 -m codesim.runner \
         --model sambanova-llama  \
-        --operation $model --wandb
+        --operation $model --wandb --cache-mode readwrite
 done
 
 
-    # python3 -m codesim.experiment --model gpt-4-azurex  --operation kim-schuster --wandb
\ No newline at end of file
+    # python3 -m codesim.experiment --model gpt-4-azurex  --operation kim-schuster --wandb --cache-mode readwrite
\ No newline at end of file
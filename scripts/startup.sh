@@ -0,0 +1,20 @@
+# Measures the cold start of `python3 -m codesim.experiment --help` with `python3 -X importtime`
+# and fails if the imports take longer than the given budget (in ms, default 1000).
+# Usage: sh scripts/startup.sh [budget_ms]
+
+budget_ms=${1:-1000}
+log=$(mktemp)
+
+python3 -X importtime -m codesim.experiment --help > /dev/null 2> $log || { cat $log; rm -f $log; exit 1; }
+
+echo "Slowest top-level imports (cumulative us):"
+awk -F'|' '/^import time: *[0-9]/ && $3 ~ /^ [^ ]/ {print $2 "|" $3}' $log | sort -n -r | head -10
+
+total_ms=$(awk -F'|' '/^import time: *[0-9]/ && $3 ~ /^ [^ ]/ {sum += $2} END {print int(sum / 1000)}' $log)
+rm -f $log
+
+echo "Total import time: ${total_ms} ms (budget: ${budget_ms} ms)"
+if [ $total_ms -gt $budget_ms ]; then
+    echo "Startup is slower than the budget"
+    exit 1
+fi